@@ -0,0 +1,230 @@
+"""Self-hosted front-end assets.
+
+`python assets.py` builds everything the page loads into `static/dist/`:
+
+- Tailwind CSS compiled ahead of time from the classes used in main.py and
+  static/chat.js, with static/app.css appended
+- vendored htmx, zero-md, highlight.js and KaTeX (with its fonts),
+  downloaded once into `static/vendor/`
+- static/chat.js
+
+Every file is written under a content-hashed name, with gzip and (when the
+optional `brotli` package is installed) brotli variants next to it, plus a
+`manifest.json` mapping logical names to hashed ones. The app serves the
+build from /assets with immutable cache headers when the manifest exists,
+and falls back to the CDNs otherwise.
+
+    python assets.py --tailwind "npx --yes @tailwindcss/cli@4"
+"""
+import os
+import re
+import gzip
+import json
+import shlex
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from urllib.parse import urljoin
+
+from starlette.datastructures import Headers, QueryParams
+from starlette.exceptions import HTTPException
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always built
+    brotli = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(HERE, "static")
+MANIFEST = "manifest.json"
+
+JSDELIVR = "https://cdn.jsdelivr.net"
+HLJS = f"{JSDELIVR}/gh/highlightjs/cdn-release@11.11.1/build"
+HLJS_COPY = f"{JSDELIVR}/gh/arronhunt/highlightjs-copy@1.0.6/dist"
+KATEX = f"{JSDELIVR}/npm/katex@0.16.22/dist"
+
+# Logical asset name -> files concatenated into it, in order
+VENDOR = {
+    "htmx.js": [f"{JSDELIVR}/npm/htmx.org@2.0.7/dist/htmx.min.js"],
+    "fasthtml.js": [f"{JSDELIVR}/gh/answerdotai/fasthtml-js@1.0.12/fasthtml.js"],
+    "zero-md.js": [f"{JSDELIVR}/npm/zero-md@3/dist/index.min.js"],
+    # The common build already includes every language the chat highlights
+    "highlight.js": [f"{HLJS}/highlight.min.js", f"{HLJS_COPY}/highlightjs-copy.min.js"],
+    "highlight-dark.css": [f"{HLJS}/styles/atom-one-dark.min.css", f"{HLJS_COPY}/highlightjs-copy.min.css"],
+    "highlight-light.css": [f"{HLJS}/styles/atom-one-light.min.css", f"{HLJS_COPY}/highlightjs-copy.min.css"],
+    "katex.js": [f"{KATEX}/katex.min.js", f"{KATEX}/contrib/auto-render.min.js"],
+    "katex.css": [f"{KATEX}/katex.min.css"],
+}
+
+COMPRESSIBLE = (".js", ".css", ".svg", ".json")
+CSS_URL = re.compile(r"url\((['\"]?)(?!data:|https?:|/)([^'\")]+)\1\)")
+
+
+def load_manifest(dist):
+    """Logical name -> hashed file name of a build, or None if there is none"""
+    try:
+        with open(os.path.join(dist, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class PrecompressedFiles(StaticFiles):
+    """Content-hashed build files, served with their precompressed variant when accepted.
+
+    Names change whenever contents do, so responses are cacheable forever.
+    """
+
+    async def get_response(self, path, scope):
+        accepted = Headers(scope=scope).get("accept-encoding", "")
+        response = None
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in accepted:
+                try:
+                    response = await super().get_response(path + suffix, scope)
+                except HTTPException:
+                    continue
+                response.headers["content-encoding"] = encoding
+                break
+        if response is None:
+            response = await super().get_response(path, scope)
+        response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        response.headers["vary"] = "accept-encoding"
+        return response
+
+
+class VersionedFiles(StaticFiles):
+    """Source files of static/, served without a build.
+
+    Pages link them with a `?v=` content hash, so a versioned request is
+    cacheable forever; a bare one is revalidated every time.
+    """
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if "v" in QueryParams(scope["query_string"]):
+            response.headers["cache-control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["cache-control"] = "no-cache"
+        return response
+
+
+# Build
+
+def fetch(url, cache):
+    """Bytes at `url`, downloaded once into `cache`"""
+    path = os.path.join(cache, re.sub(r"[^\w.@-]+", "_", url.split("://", 1)[1]))
+    if not os.path.exists(path):
+        with urllib.request.urlopen(url, timeout=60) as response:
+            data = response.read()
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def hashed_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.blake2b(data, digest_size=8).hexdigest()}{ext}"
+
+
+def write_asset(out, name, data, manifest):
+    """Write `data` under a content-hashed name, with compressed variants"""
+    filename = hashed_name(name, data)
+    with open(os.path.join(out, filename), "wb") as f:
+        f.write(data)
+    if filename.endswith(COMPRESSIBLE):
+        variants = [(".gz", gzip.compress(data, 9, mtime=0))]
+        if brotli is not None:
+            variants.append((".br", brotli.compress(data, quality=11)))
+        for suffix, compressed in variants:
+            # Only worth serving if it actually saves bytes
+            if len(compressed) < len(data):
+                with open(os.path.join(out, filename + suffix), "wb") as f:
+                    f.write(compressed)
+    manifest[name] = filename
+    return filename
+
+
+def vendor_css(urls, out, cache, manifest):
+    """Concatenate stylesheets, vendoring the fonts and images they reference"""
+    parts = []
+    for url in urls:
+        css = fetch(url, cache).decode()
+
+        def local(match):
+            ref = match.group(2)
+            name = os.path.basename(ref.split("?")[0].split("#")[0])
+            return f"url({write_asset(out, name, fetch(urljoin(url, ref), cache), manifest)})"
+
+        parts.append(CSS_URL.sub(local, css))
+    return "\n".join(parts).encode()
+
+
+def compile_tailwind(tailwind, sources, extra_css):
+    """Run the Tailwind CLI over `sources` and return the minified CSS"""
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "input.css")
+        dst = os.path.join(tmp, "output.css")
+        with open(src, "w") as f:
+            f.write('@import "tailwindcss" source(none);\n')
+            for path in sources:
+                f.write(f'@source "{path}";\n')
+            f.write(extra_css)
+        subprocess.run(shlex.split(tailwind) + ["-i", src, "-o", dst, "--minify"], check=True, cwd=HERE)
+        with open(dst, "rb") as f:
+            return f.read()
+
+
+def build(out, cache, tailwind):
+    os.makedirs(out, exist_ok=True)
+    os.makedirs(cache, exist_ok=True)
+    for name in os.listdir(out):
+        os.remove(os.path.join(out, name))
+
+    manifest = {}
+    for name, urls in VENDOR.items():
+        if name.endswith(".css"):
+            data = vendor_css(urls, out, cache, manifest)
+        else:
+            data = b"\n;\n".join(fetch(url, cache) for url in urls)
+        write_asset(out, name, data, manifest)
+
+    with open(os.path.join(STATIC_DIR, "app.css")) as f:
+        app_css = f.read()
+    sources = [os.path.join(HERE, "main.py"), os.path.join(STATIC_DIR, "chat.js")]
+    write_asset(out, "app.css", compile_tailwind(tailwind, sources, app_css), manifest)
+    with open(os.path.join(STATIC_DIR, "chat.js"), "rb") as f:
+        write_asset(out, "chat.js", f.read(), manifest)
+
+    with open(os.path.join(out, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=os.path.join(STATIC_DIR, "dist"), help="build directory")
+    parser.add_argument("--cache", default=os.path.join(STATIC_DIR, "vendor"), help="download cache")
+    parser.add_argument("--tailwind", default=os.getenv("TAILWIND_CLI", "npx --yes @tailwindcss/cli@4"),
+                        help="Tailwind CLI command (the standalone binary works too)")
+    args = parser.parse_args()
+
+    manifest = build(args.out, args.cache, args.tailwind)
+    for name, filename in sorted(manifest.items()):
+        path = os.path.join(args.out, filename)
+        sizes = [f"{os.path.getsize(path):>9,}"]
+        for suffix in (".gz", ".br"):
+            if os.path.exists(path + suffix):
+                sizes.append(f"{suffix[1:]} {os.path.getsize(path + suffix):>8,}")
+        print(f"{filename:<44} {'  '.join(sizes)}")
+    if brotli is None:
+        print("brotli is not installed; only gzip variants were built")
+
+
+if __name__ == "__main__":
+    main()
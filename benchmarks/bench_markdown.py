@@ -0,0 +1,80 @@
+"""Server-side markdown rendering cost for a streamed answer.
+
+Streams a long, code- and math-heavy answer in `--chunk`-character deltas
+and compares re-rendering the whole answer on every delta (what the client
+used to do per frame) with rendering each finished block once and
+re-rendering only the trailing partial block. Also reports the HTML sent
+per event and how long a history reload takes once the blocks are cached.
+
+    python benchmarks/bench_markdown.py --sections 40 --chunk 80
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import rendering
+from fragments import FragmentCache, content_hash
+
+SECTION = """## Step {i}
+
+We compute the value with $f(x) = x^{i} + \\frac{{1}}{{x}}$ and check the bound
+$$
+\\sum_{{k=1}}^{{n}} k^2 = \\frac{{n(n+1)(2n+1)}}{{6}}
+$$
+
+```python
+def step_{i}(values):
+    return [v ** {i} for v in values if v > 0]
+```
+
+- first point about step {i}
+- second point with **bold** and `inline code`
+
+"""
+
+
+def answer(sections):
+    return "".join(SECTION.format(i=i) for i in range(sections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=40)
+    parser.add_argument("--chunk", type=int, default=80, help="characters per streamed delta")
+    args = parser.parse_args()
+    if not rendering.AVAILABLE:
+        sys.exit("markdown-it-py is not installed")
+
+    text = answer(args.sections)
+    deltas = [text[i:i + args.chunk] for i in range(0, len(text), args.chunk)]
+    print(f"answer: {len(text):,} chars, {len(deltas)} deltas")
+
+    t0 = time.perf_counter()
+    full_bytes = 0
+    for n in range(1, len(deltas) + 1):
+        full_bytes += len(rendering.render_markdown("".join(deltas[:n])))
+    full = time.perf_counter() - t0
+    print(f"  full re-render per delta   {full * 1000:9.1f} ms  {full_bytes:>12,} B of HTML")
+
+    cache = FragmentCache()
+    render_block = lambda source: cache.render(content_hash("md", source), lambda: rendering.render_markdown(source))
+    t0 = time.perf_counter()
+    sent = 0
+    stream = rendering.BlockStream(render_block)
+    for delta in deltas:
+        sent += sum(map(len, stream.feed(delta))) + len(stream.tail())
+    sent += sum(map(len, stream.close()))
+    incremental = time.perf_counter() - t0
+    print(f"  incremental blocks         {incremental * 1000:9.1f} ms  {sent:>12,} B of HTML sent "
+          f"({full / incremental:.0f}x less CPU)")
+
+    t0 = time.perf_counter()
+    html = "".join(render_block(block) for block in rendering.split_blocks(text))
+    reload = time.perf_counter() - t0
+    print(f"  history reload (cached)    {reload * 1000:9.2f} ms  {len(html):>12,} B, {cache.stats()['hits']} block hits")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""Page weight and estimated first paint, CDN assets against the local build.
+
+Renders `/` once per mode and lists the scripts and stylesheets it loads,
+which of them block rendering and which come from third-party origins.
+Local assets are fetched through the app with `Accept-Encoding: br, gzip`
+to get their transfer size; CDN assets are fetched too with `--fetch-cdn`
+(needs network access), and are otherwise reported as unknown.
+
+First paint is estimated from the critical path: the HTML, then every
+render-blocking resource, paying a connection setup (3 round trips) per
+new origin and sharing `--mbps` of bandwidth. The CDN mode also compiles
+Tailwind in the browser before styled content can paint, which this does
+not include; use Lighthouse for real numbers.
+
+    python assets.py                      # build static/dist first
+    python benchmarks/bench_page_weight.py --rtt-ms 100 --mbps 10
+"""
+import os
+import sys
+import gzip
+import json
+import argparse
+import subprocess
+from pathlib import Path
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class Resources(HTMLParser):
+    """Scripts and stylesheets a page loads, in document order"""
+
+    def __init__(self):
+        super().__init__()
+        self.found = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "script" and attrs.get("src"):
+            blocking = "defer" not in attrs and "async" not in attrs and attrs.get("type") != "module"
+            self.found.append((attrs["src"], blocking))
+        elif tag == "link" and attrs.get("rel") == "stylesheet":
+            self.found.append((attrs["href"], True))
+
+
+def probe(fetch_cdn):
+    """Run inside a subprocess so main picks up this mode's ASSET_DIST"""
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["CONVERSATION_DB"] = ""
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)
+    import main
+    from starlette.testclient import TestClient
+
+    client = TestClient(main.app)
+    html = client.get("/").content
+    parser = Resources()
+    parser.feed(html.decode())
+
+    resources = []
+    for url, blocking in parser.found:
+        third_party = bool(urlsplit(url).netloc)
+        size = None
+        if not third_party:
+            size = int(client.get(url, headers={"accept-encoding": "br, gzip"}).headers["content-length"])
+        elif fetch_cdn:
+            import httpx
+            try:
+                size = int(httpx.head(url, headers={"accept-encoding": "br, gzip"}, follow_redirects=True,
+                                      timeout=10).headers.get("content-length", 0)) or None
+            except httpx.HTTPError:
+                pass
+        resources.append({"url": url, "blocking": blocking, "third_party": third_party, "bytes": size})
+    return {"html_bytes": len(html), "html_gzip": len(gzip.compress(html)), "resources": resources}
+
+
+def run_probe(dist, fetch_cdn):
+    env = {**os.environ, "ASSET_DIST": str(dist)}
+    args = [sys.executable, __file__, "--probe"] + (["--fetch-cdn"] if fetch_cdn else [])
+    return json.loads(subprocess.run(args, env=env, check=True, capture_output=True, text=True).stdout)
+
+
+def estimate_first_paint(page, rtt, bytes_per_s):
+    """Critical-path estimate in seconds; unknown sizes count as zero bytes"""
+    html = 4 * rtt + page["html_gzip"] / bytes_per_s  # DNS, TCP, TLS, request
+    blocking = [r for r in page["resources"] if r["blocking"]]
+    origins = {urlsplit(r["url"]).netloc for r in blocking if r["third_party"]}
+    setup = 3 * rtt if origins else 0
+    transfer = sum(r["bytes"] or 0 for r in blocking) / bytes_per_s
+    return html + (setup + rtt + transfer if blocking else 0)
+
+
+def report(name, page, rtt, bytes_per_s):
+    resources = page["resources"]
+    known = [r["bytes"] for r in resources if r["bytes"] is not None]
+    unknown = len(resources) - len(known)
+    blocking = [r for r in resources if r["blocking"]]
+    print(f"[{name}]")
+    print(f"  html               {page['html_bytes']:>9,} B ({page['html_gzip']:,} B gzip)")
+    print(f"  resources          {len(resources):>9} ({sum(r['third_party'] for r in resources)} third-party, "
+          f"{len(blocking)} render-blocking)")
+    print(f"  resource bytes     {sum(known):>9,} B transferred" + (f" + {unknown} of unknown size" if unknown else ""))
+    print(f"  blocking bytes     {sum(r['bytes'] or 0 for r in blocking):>9,} B")
+    # Anything outside /assets may be revalidated or refetched on the next visit
+    print(f"  not immutable      {sum('/assets/' not in r['url'] for r in resources):>9}")
+    print(f"  est. first paint   {estimate_first_paint(page, rtt, bytes_per_s) * 1000:>9.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dist", default=str(ROOT / "static" / "dist"), help="local build to compare against")
+    parser.add_argument("--rtt-ms", type=float, default=100)
+    parser.add_argument("--mbps", type=float, default=10)
+    parser.add_argument("--fetch-cdn", action="store_true", help="HEAD third-party assets for their sizes")
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        print(json.dumps(probe(args.fetch_cdn)))
+        return
+
+    rtt, bytes_per_s = args.rtt_ms / 1000, args.mbps * 1e6 / 8
+    report("cdn", run_probe(ROOT / "static" / "no-build", args.fetch_cdn), rtt, bytes_per_s)
+    if not (Path(args.dist) / "manifest.json").exists():
+        print(f"no build at {args.dist}; run `python assets.py` to compare")
+        return
+    report("local build", run_probe(args.dist, args.fetch_cdn), rtt, bytes_per_s)
+
+
+if __name__ == "__main__":
+    main()
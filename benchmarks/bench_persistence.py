@@ -0,0 +1,68 @@
+"""Append throughput and cold-load latency of the SQLite conversation backend.
+
+Appends `--messages` messages to each of `--conversations` conversations,
+interleaved the way concurrent users would write them, then times
+`load_recent` for a random sample of conversations.
+
+    python benchmarks/bench_persistence.py --conversations 10000 --messages 20
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from persistence import SQLiteBackend
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--message-chars", type=int, default=400)
+    parser.add_argument("--load-limit", type=int, default=50)
+    parser.add_argument("--samples", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = SQLiteBackend(os.path.join(tmp, "bench.db"))
+        text = "x" * args.message_chars
+        sessions = [f"session-{i}" for i in range(args.conversations)]
+        total = args.conversations * args.messages
+
+        start = time.perf_counter()
+        for seq in range(1, args.messages + 1):
+            sender = "user" if seq % 2 else "ai"
+            for sid in sessions:
+                backend.append(sid, seq, sender, text)
+        enqueued = time.perf_counter() - start
+        backend.flush()
+        committed = time.perf_counter() - start
+
+        print(f"appends:        {total} messages across {args.conversations} conversations")
+        print(f"enqueue:        {enqueued:.2f}s ({total / enqueued:,.0f} msg/s, "
+              f"{enqueued / total * 1e6:.2f}us per append on the caller)")
+        print(f"committed:      {committed:.2f}s ({total / committed:,.0f} msg/s)")
+
+        latencies = []
+        for sid in random.sample(sessions, min(args.samples, len(sessions))):
+            t0 = time.perf_counter()
+            rows = backend.load_recent(sid, args.load_limit)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            assert len(rows) == min(args.messages, args.load_limit)
+        print(f"load_recent({args.load_limit}): p50={statistics.median(latencies):.3f}ms "
+              f"p95={percentile(latencies, 95):.3f}ms p99={percentile(latencies, 99):.3f}ms")
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Time chat_messages() rendering at 50, 500 and 5000 messages.
+
+`cold` renders every message from scratch (empty fragment cache), `warm`
+renders the same page again with every fragment cached. Both include
+serializing the page to HTML, as a request would.
+
+    python benchmarks/bench_render.py
+"""
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ["CONVERSATION_DB"] = ""
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+from conversations import Message
+from fastcore.xml import to_xml
+
+REPLY = """Here is an example:
+
+```python
+def add(a, b):
+    return a + b
+```
+
+The sum is $a + b$ for any **numbers** you pass in."""
+
+
+def build_page(n):
+    return [Message(i, "user" if i % 2 else "ai", f"Question number {i}?" if i % 2 else REPLY) for i in range(n)]
+
+
+def timed(page, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        html = to_xml(main.chat_messages(page, None))
+        best = min(best, time.perf_counter() - t0)
+    return best, len(html)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        page = build_page(n)
+        main.fragment_cache.clear()
+        t0 = time.perf_counter()
+        html = to_xml(main.chat_messages(page, None))
+        cold = time.perf_counter() - t0
+        warm, _ = timed(page, args.repeat)
+        print(f"{n:>5} messages: cold={cold * 1000:8.2f}ms warm={warm * 1000:8.2f}ms "
+              f"({cold / warm:4.1f}x) html={len(html) / 1024:,.0f}KiB")
+
+
+if __name__ == "__main__":
+    main_()
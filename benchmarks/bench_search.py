@@ -0,0 +1,183 @@
+"""Conversation search at scale: indexing throughput and query latency.
+
+Builds a conversation database of `--messages` messages spread over
+`--sessions` conversations, appended in interleaved order through the
+app's SQLite backend (batched writer, indexed in the same transactions).
+Words follow a Zipf distribution, so some terms are in most messages and
+most are rare. Reports:
+
+- indexing throughput, next to the same rows inserted without the index
+- the size of the database and of the index
+- query latency within one conversation for a common word, a rare word,
+  a 3-letter prefix, a phrase and two words, as p50/p95/p99
+- for comparison, a naive scan of one conversation and of every message
+
+    python benchmarks/bench_search.py --messages 1000000 --sessions 2000
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import resource
+import tempfile
+import itertools
+from pathlib import Path
+
+from load_test import percentile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from conversations import ConversationStore
+from persistence import SQLiteBackend
+
+
+def vocabulary(size, rng):
+    syllables = ["ka", "lo", "mi", "ne", "ru", "ta", "so", "vi", "de", "pa", "zu", "ex", "or", "in", "ba"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(syllables, k=rng.randint(1, 4))))
+    return sorted(words, key=lambda w: (len(w), w))
+
+
+def generate(args, rng):
+    """(session_id, seq, sender, message) rows, conversations interleaved"""
+    words = vocabulary(args.vocabulary, rng)
+    weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    sessions = [f"{rng.getrandbits(128):032x}" for _ in range(args.sessions)]
+    next_seq = dict.fromkeys(sessions, 1)
+    rows = []
+    for n in range(args.messages):
+        sid = rng.choice(sessions)
+        seq = next_seq[sid]
+        next_seq[sid] += 1
+        text = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(5, args.max_words)))
+        rows.append((sid, seq, "user" if seq % 2 else "ai", text))
+    return rows, words, sessions
+
+
+def ingest(path, rows):
+    backend = SQLiteBackend(path)
+    started = time.perf_counter()
+    for row in rows:
+        backend.append(*row)
+    backend.flush()
+    elapsed = time.perf_counter() - started
+    return backend, elapsed
+
+
+def ingest_unindexed(path, rows, batch=500):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE messages (session_id TEXT NOT NULL, seq INTEGER NOT NULL, sender TEXT NOT NULL, "
+               "message TEXT NOT NULL, PRIMARY KEY (session_id, seq)) WITHOUT ROWID")
+    started = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        with db:
+            db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)", rows[i:i + batch])
+    elapsed = time.perf_counter() - started
+    db.close()
+    return elapsed
+
+
+def index_bytes(db):
+    try:
+        return db.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE 'message_index%'").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def time_queries(store, make_query, count):
+    """Latencies of `count` queries and their average number of hits; `make_query` returns (session, query)"""
+    latencies = []
+    hits = 0
+    for _ in range(count):
+        session_id, query = make_query()
+        started = time.perf_counter()
+        hits += len(store.search(session_id, query, limit=21))
+        latencies.append(time.perf_counter() - started)
+    return latencies, hits / count
+
+
+def row(name, latencies, hits):
+    print(f"  {name:<14} p50={percentile(latencies, 50) * 1000:7.2f}ms p95={percentile(latencies, 95) * 1000:7.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:7.2f}ms  {hits:5.1f} hits/query")
+
+
+def run(args, tmp):
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    rows, words, sessions = generate(args, rng)
+    print(f"{args.messages:,} messages in {args.sessions:,} conversations, "
+          f"{sum(len(r[3]) for r in rows) / 1e6:.0f}MB of text (generated in {time.perf_counter() - started:.0f}s)")
+
+    print("[indexing]")
+    plain = ingest_unindexed(os.path.join(tmp, "plain.db"), rows)
+    print(f"  without index  {args.messages / plain:9,.0f} messages/s")
+    path = os.path.join(tmp, "conversations.db")
+    backend, indexed = ingest(path, rows)
+    print(f"  with index     {args.messages / indexed:9,.0f} messages/s")
+    size = index_bytes(backend._reader)
+    print(f"  database       {os.path.getsize(path) / 2**20:9,.0f}MiB"
+          + (f", index {size / 2**20:,.0f}MiB" if size else ""))
+
+    print("[queries] within one conversation")
+    store = ConversationStore(backend=backend)
+    common, rare = words[:10], words[len(words) // 2:]
+    samples = rng.sample(rows, 1000)
+
+    def phrase():
+        # Two adjacent words of a message in the conversation searched
+        session_id, _, _, message = rng.choice(samples)
+        text = message.split()
+        i = rng.randrange(len(text) - 1)
+        return session_id, f'"{text[i]} {text[i + 1]}"'
+
+    queries = {
+        "common word": lambda: (rng.choice(sessions), rng.choice(common)),
+        "rare word": lambda: (rng.choice(sessions), rng.choice(rare)),
+        "prefix": lambda: (rng.choice(sessions), rng.choice(words[100:1000])[:3] + "*"),
+        "phrase": phrase,
+        "two words": lambda: (rng.choice(sessions), f"{rng.choice(words[:200])} {rng.choice(words[:200])}"),
+    }
+    for name, make_query in queries.items():
+        row(name, *time_queries(store, make_query, args.queries))
+
+    print("[naive scan] for comparison")
+    word = common[5]
+    latencies = []
+    hits = 0
+    for _ in range(min(args.queries, 50)):
+        started = time.perf_counter()
+        history = backend.load_recent(rng.choice(sessions), 2 ** 31)
+        hits += len([seq for seq, _, message in history if word in message.split()][:21])
+        latencies.append(time.perf_counter() - started)
+    row("conversation", latencies, hits / min(args.queries, 50))
+    started = time.perf_counter()
+    with backend._read_lock:
+        matches = sum(word in message.split() for (message,) in backend._reader.execute("SELECT message FROM messages"))
+    print(f"  every message  {(time.perf_counter() - started) * 1000:9.0f}ms ({matches:,} matches)")
+    print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}MiB (including the generated rows)")
+    backend.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--vocabulary", type=int, default=30000, help="distinct words")
+    parser.add_argument("--max-words", type=int, default=60, help="longest message, in words")
+    parser.add_argument("--queries", type=int, default=200, help="queries per query type")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", help="where to build the databases (default: a temporary directory)")
+    args = parser.parse_args()
+    if args.dir:
+        run(args, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(args, tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Slow readers against one streaming reply.
+
+A producer publishes `--tokens` chunks at `--token-rate` per second into a
+response buffer, the way the app does from upstream. Several simulated
+clients read it at the same time, each taking a fixed time per event it
+receives, like a connection that can only take so many writes a second:
+
+- fast: takes events as soon as they come
+- slow: slower than the provider, so buffered chunks get merged
+- stalled: each write takes longer than `--max-lag`, so the slow-client policy applies
+
+Reports how long the producer took to drain (it should match the provider
+regardless of the readers), then what each reader got. Every reader that
+was not disconnected must end up with exactly the published text; the
+script exits non-zero if one does not.
+
+    python benchmarks/bench_slow_client.py --tokens 400 --token-rate 200 --max-lag 1
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from streaming import ResponseBuffer
+
+READERS = {"fast": 0.0, "slow": 0.05, "stalled": 2.0}
+
+
+async def produce(buffer, tokens, rate):
+    started = time.perf_counter()
+    buffer.publish({"type": "start", "content": ""})
+    for n in range(tokens):
+        buffer.publish({"type": "chunk", "content": f"token{n} "})
+        await asyncio.sleep(1 / rate)
+    buffer.publish({"type": "complete"})
+    buffer.finish()
+    return time.perf_counter() - started
+
+
+async def read(buffer, per_event):
+    """What a client following the stream would show, and what it took to get there"""
+    started = time.perf_counter()
+    text = ""
+    got = {"events": 0, "chunks": 0, "snapshots": 0, "bytes": 0, "done": False}
+    async for event in buffer.subscribe(0, heartbeat=5):
+        got["events"] += 1
+        got["bytes"] += len(event)
+        if event.startswith(":"):
+            continue
+        payload = event.split("data: ", 1)[1].strip()
+        if payload == "[DONE]":
+            got["done"] = True
+        else:
+            data = json.loads(payload)
+            if data["type"] == "chunk":
+                got["chunks"] += 1
+                text += data["content"]
+            elif data["type"] == "snapshot":
+                got["snapshots"] += 1
+                text = data["content"]
+        await asyncio.sleep(per_event)
+    got["seconds"] = time.perf_counter() - started
+    return text, got
+
+
+async def run(args, policy):
+    buffer = ResponseBuffer(max_events=args.max_events, max_lag=args.max_lag, slow_policy=policy)
+    slow = []
+    buffer.on_slow = slow.append
+    readers = {name: asyncio.create_task(read(buffer, delay)) for name, delay in READERS.items()}
+    drained = await produce(buffer, args.tokens, args.token_rate)
+    expected = buffer.text
+    results = {name: await task for name, task in readers.items()}
+
+    print(f"[policy={policy}] producer drained {args.tokens} chunks in {drained:.2f}s "
+          f"(provider pace {args.tokens / args.token_rate:.2f}s), slow clients: {len(slow)}")
+    ok = True
+    for name, (text, got) in results.items():
+        if got["done"]:
+            outcome = "correct" if text == expected else "WRONG TEXT"
+            ok = ok and text == expected
+        else:
+            outcome = "disconnected"
+        print(f"  {name:<8} {got['events']:5} events {got['chunks']:5} chunks {got['snapshots']} snapshots "
+              f"{got['bytes'] / 1024:7.1f}KB {got['seconds']:6.2f}s  {outcome}")
+    return ok
+
+
+async def main_async(args):
+    ok = True
+    for policy in ("final", "disconnect"):
+        ok = await run(args, policy) and ok
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--token-rate", type=float, default=200.0, help="chunks per second from the provider")
+    parser.add_argument("--max-lag", type=float, default=1.0, help="seconds behind before a client counts as slow")
+    parser.add_argument("--max-events", type=int, default=256, help="events kept for resuming")
+    args = parser.parse_args()
+    if not asyncio.run(main_async(args)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
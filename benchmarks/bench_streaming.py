@@ -0,0 +1,66 @@
+"""Compare per-delta SSE events with coalesced events for a simulated reply.
+
+Reports events per reply, SSE bytes, server-side encode time, and the
+number of characters the client re-parses (each render re-parses the whole
+answer so far). The old client rendered per event; the new one renders at
+most once per animation frame.
+
+    python benchmarks/bench_streaming.py --tokens 1500 --token-ms 8
+"""
+import sys
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from streaming import coalesce, sse_event
+
+FRAME_SECONDS = 1 / 60
+
+
+async def fake_tokens(n, interval):
+    for i in range(n):
+        await asyncio.sleep(interval)
+        yield f"tok{i % 97} "
+
+
+async def run(label, chunks, per_frame):
+    events = sse_bytes = reparsed = renders = 0
+    encode = 0.0
+    content = ""
+    last_render = 0.0
+    start = time.perf_counter()
+    async for chunk in chunks:
+        t0 = time.perf_counter()
+        sse_bytes += len(sse_event({"type": "chunk", "content": chunk}))
+        encode += time.perf_counter() - t0
+        events += 1
+        content += chunk
+        now = time.perf_counter()
+        if not per_frame or now - last_render >= FRAME_SECONDS:
+            reparsed += len(content)
+            renders += 1
+            last_render = now
+    total = time.perf_counter() - start
+    print(f"{label:<22} events={events:<6} renders={renders:<6} sse_bytes={sse_bytes:<8} "
+          f"encode_ms={encode * 1000:7.2f} reparsed_chars={reparsed:<10} wall_s={total:.2f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=1500)
+    parser.add_argument("--token-ms", type=float, default=8)
+    parser.add_argument("--flush-ms", type=float, default=50)
+    parser.add_argument("--flush-chars", type=int, default=1024)
+    args = parser.parse_args()
+
+    interval = args.token_ms / 1000
+    await run("before (per delta)", fake_tokens(args.tokens, interval), per_frame=False)
+    await run("after (coalesced+rAF)",
+              coalesce(fake_tokens(args.tokens, interval), args.flush_ms / 1000, args.flush_chars),
+              per_frame=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
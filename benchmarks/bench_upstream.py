@@ -0,0 +1,131 @@
+"""Upstream warmup, latency routing and hedged requests against fake endpoints.
+
+Starts two local fake OpenAI servers: a fast one (`--latency`) and one
+`--slow-factor` times slower, both with a `--tail` fraction of replies
+that take `--tail-latency` seconds to start. Then, using the app's model
+backend directly:
+
+- first-request TTFT of a cold backend against one warmed up at startup
+- how requests split between the fast and slow endpoint, and their TTFT
+- TTFT percentiles with hedging off and hedged at `--hedge-percentile`
+
+    python benchmarks/bench_upstream.py --requests 300 --concurrency 10 --tail 0.1
+"""
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+from pathlib import Path
+
+from load_test import free_port, percentile, wait_ready
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+from upstream import Endpoint, OpenAIBackend
+
+MESSAGES = [{"role": "user", "content": "What should I know?"}]
+
+
+def endpoint(url, name):
+    return Endpoint("gpt-4o-mini", base_url=f"{url}/v1", api_key="fake", name=name)
+
+
+async def first_token(backend):
+    start = time.perf_counter()
+    ttft = None
+    async for _ in backend.stream(MESSAGES):
+        ttft = ttft or time.perf_counter() - start
+    return ttft
+
+
+async def drive(backend, requests, concurrency):
+    """TTFTs of `requests` streams, `concurrency` at a time"""
+    ttfts = []
+    queue = iter(range(requests))
+
+    async def worker():
+        for _ in queue:
+            ttfts.append(await first_token(backend))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return ttfts
+
+
+def row(name, ttfts):
+    print(f"  {name:<22} p50={percentile(ttfts, 50) * 1000:7.1f}ms p95={percentile(ttfts, 95) * 1000:7.1f}ms "
+          f"p99={percentile(ttfts, 99) * 1000:7.1f}ms")
+
+
+async def run(args, fast_url, slow_url):
+    print("[warmup] first request")
+    for warm in (False, True):
+        backend = OpenAIBackend([endpoint(fast_url, "fast")])
+        if warm:
+            await backend.warmup()
+        ttft = await first_token(backend)
+        print(f"  {'warmed up' if warm else 'cold':<22} {ttft * 1000:7.1f}ms")
+        await backend.close()
+
+    print("[routing] fast and slow endpoint")
+    backend = OpenAIBackend([endpoint(fast_url, "fast"), endpoint(slow_url, "slow")])
+    ttfts = await drive(backend, args.requests, args.concurrency)
+    share = {name: stats["requests"] for name, stats in backend.stats()["endpoints"].items()}
+    print(f"  requests               fast={share['fast']} slow={share['slow']}")
+    row("ttft", ttfts)
+    await backend.close()
+
+    print(f"[hedging] at p{args.hedge_percentile:g}, budget {args.hedge_budget:.0%}")
+    for hedge in (None, args.hedge_percentile):
+        backend = OpenAIBackend([endpoint(fast_url, "fast"), endpoint(slow_url, "slow")],
+                                hedge_percentile=hedge, hedge_budget=args.hedge_budget)
+        # Learn each endpoint's latency before measuring
+        await drive(backend, 40, args.concurrency)
+        ttfts = await drive(backend, args.requests, args.concurrency)
+        stats = backend.stats()
+        label = "hedged" if hedge else "not hedged"
+        row(label, ttfts)
+        if hedge:
+            print(f"  {'hedges':<22} {stats['hedges']} ({stats['hedge_wins']} won by the hedge) "
+                  f"of {stats['requests']} requests")
+        await backend.close()
+
+
+async def main_async(args):
+    fast_port, slow_port = free_port(), free_port()
+    common = ["--tokens", "5", "--token-rate", "500", "--jitter", str(args.jitter),
+              "--tail", str(args.tail), "--tail-latency", str(args.tail_latency)]
+    procs = [
+        subprocess.Popen([sys.executable, str(HERE / "fake_openai.py"), "--port", str(fast_port),
+                          "--latency", str(args.latency), *common]),
+        subprocess.Popen([sys.executable, str(HERE / "fake_openai.py"), "--port", str(slow_port),
+                          "--latency", str(args.latency * args.slow_factor), *common]),
+    ]
+    try:
+        fast_url, slow_url = f"http://127.0.0.1:{fast_port}", f"http://127.0.0.1:{slow_port}"
+        await wait_ready(f"{fast_url}/v1/models")
+        await wait_ready(f"{slow_url}/v1/models")
+        await run(args, fast_url, slow_url)
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.1, help="first-token latency of the fast endpoint")
+    parser.add_argument("--slow-factor", type=float, default=3, help="how much slower the second endpoint is")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--tail", type=float, default=0.1, help="fraction of slow-starting replies")
+    parser.add_argument("--tail-latency", type=float, default=1.5)
+    parser.add_argument("--hedge-percentile", type=float, default=90)
+    parser.add_argument("--hedge-budget", type=float, default=0.15)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
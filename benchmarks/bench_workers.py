@@ -0,0 +1,149 @@
+"""Throughput against the number of worker processes.
+
+For each `--workers` count, starts the app under uvicorn with that many
+workers sharing one port (WORKERS=N, so conversations and in-flight
+replies go through the shared SQLite files), pointed at the local fake
+OpenAI server. `--users` closed-loop users then send messages over the
+single-request path for `--duration` seconds, spread over
+`--client-procs` load-generator processes so the client does not become
+the bottleneck. Reports replies/s, streamed tokens/s and time to first
+token per worker count.
+
+The upstream is fast by default so the app's own CPU (SSE framing,
+server-side markdown rendering) is what saturates; replies/s only scales
+as long as there are idle cores, for the app and for the fake upstream
+and the clients too.
+
+    python benchmarks/bench_workers.py --workers 1,2,4 --users 64 --duration 20
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import httpx
+
+from fake_openai import add_model_args
+from load_test import Results, free_port, percentile, run_turn_single, wait_ready
+
+HERE = Path(__file__).resolve().parent
+ROOT = HERE.parent
+
+
+async def drive(url, users, duration):
+    """Closed-loop users sending one message after another until `duration` is up"""
+    results = Results()
+    deadline = time.monotonic() + duration
+
+    async def user(n):
+        async with httpx.AsyncClient(base_url=url, timeout=300) as http:
+            await http.get("/")
+            turn = 0
+            while time.monotonic() < deadline:
+                try:
+                    await run_turn_single(http, f"User {n} question {turn}: what should I know?", results, 0)
+                except Exception as e:
+                    results.errors += 1
+                    print(f"user {n}: {e}", file=sys.stderr)
+                turn += 1
+
+    await asyncio.gather(*(user(n) for n in range(users)))
+    return {"ttft": results.ttft, "tokens": results.tokens, "errors": results.errors}
+
+
+def run_clients(url, users, procs, duration):
+    """Split `users` over `procs` load-generator processes and merge what they measured"""
+    per_proc = [users // procs + (i < users % procs) for i in range(procs)]
+    clients = [
+        subprocess.Popen([sys.executable, __file__, "--drive", url, "--users", str(n), "--duration", str(duration)],
+                         stdout=subprocess.PIPE, text=True)
+        for n in per_proc if n
+    ]
+    merged = {"ttft": [], "tokens": 0, "errors": 0}
+    for client in clients:
+        out, _ = client.communicate()
+        result = json.loads(out)
+        merged["ttft"] += result["ttft"]
+        merged["tokens"] += result["tokens"]
+        merged["errors"] += result["errors"]
+    return merged
+
+
+async def run_level(workers, args, env, tmp):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(ROOT), "--port", str(port),
+           "--workers", str(workers), "--log-level", "warning"]
+    app = subprocess.Popen(cmd, env={**env, "WORKERS": str(workers)}, cwd=tmp)
+    try:
+        await wait_ready(f"{url}/stats")
+        # Every worker imports the app on its own; let the slower ones come up
+        await asyncio.sleep(args.settle)
+        start = time.perf_counter()
+        result = await asyncio.to_thread(run_clients, url, args.users, args.client_procs, args.duration)
+        return result, time.perf_counter() - start
+    finally:
+        app.terminate()
+        app.wait()
+
+
+async def run(args):
+    fake_port = free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    fake_cmd = [sys.executable, str(HERE / "fake_openai.py"), "--port", str(fake_port),
+                "--tokens", str(args.tokens), "--token-rate", str(args.token_rate),
+                "--latency", str(args.latency), "--jitter", str(args.jitter)]
+    fake = subprocess.Popen(fake_cmd)
+    try:
+        await wait_ready(f"{fake_url}/v1/models")
+        print(f"{os.cpu_count()} CPUs, {args.users} users, {args.duration:.0f}s per level, "
+              f"{args.tokens} tokens per reply at {args.token_rate:.0f}/s")
+        base = None
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as tmp:
+                env = {
+                    **os.environ,
+                    "OPENAI_BASE_URL": f"{fake_url}/v1",
+                    "OPENAI_API_KEY": "fake",
+                    "CONVERSATION_DB": os.path.join(tmp, "conversations.db"),
+                    "STREAM_BROKER_DB": os.path.join(tmp, "streams.db"),
+                    "RESPONSE_CACHE_TTL": "0",
+                }
+                result, elapsed = await run_level(workers, args, env, tmp)
+            replies = len(result["ttft"]) / elapsed
+            base = base or replies
+            print(f"  workers={workers:<2} {replies:8.1f} replies/s ({replies / base:4.2f}x)  "
+                  f"{result['tokens'] / elapsed:9,.0f} tokens/s  "
+                  f"ttft p50={percentile(result['ttft'], 50) * 1000:7.1f}ms "
+                  f"p95={percentile(result['ttft'], 95) * 1000:7.1f}ms  errors={result['errors']}")
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=lambda s: [int(n) for n in s.split(",")], default=[1, 2, 4],
+                        help="comma-separated worker counts to compare")
+    parser.add_argument("--users", type=int, default=64, help="concurrent closed-loop users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load per worker count")
+    parser.add_argument("--client-procs", type=int, default=2, help="load-generator processes")
+    parser.add_argument("--settle", type=float, default=2, help="seconds to let every worker start")
+    parser.add_argument("--drive", metavar="URL", help=argparse.SUPPRESS)
+    add_model_args(parser)
+    parser.set_defaults(tokens=100, token_rate=1000.0, latency=0.05)
+    args = parser.parse_args()
+
+    if args.drive:
+        print(json.dumps(asyncio.run(drive(args.drive, args.users, args.duration))))
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
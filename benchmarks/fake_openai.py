@@ -0,0 +1,129 @@
+"""Local OpenAI-compatible chat completions server for offline benchmarking.
+
+Streams `--tokens` tokens per reply at `--token-rate` tokens/s after
+`--latency` seconds, with uniform `--jitter` applied to every delay. A
+fraction `--tail` of replies waits `--tail-latency` seconds instead, like
+a provider's slow tail. Point the app at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+    python benchmarks/fake_openai.py --port 8765 --token-rate 80 --latency 0.3
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+class FakeModel:
+    """Timing profile for generated replies"""
+
+    def __init__(self, tokens=200, token_rate=50.0, latency=0.3, jitter=0.2, seed=None, tail=0.0, tail_latency=2.0):
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.tail = tail
+        self.tail_latency = tail_latency
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def delay(self, seconds):
+        """Apply +/- `jitter` (a fraction) to a nominal delay"""
+        return max(seconds * (1 + self.random.uniform(-self.jitter, self.jitter)), 0)
+
+    def first_token_delay(self):
+        slow = self.random.random() < self.tail
+        return self.delay(self.tail_latency if slow else self.latency)
+
+    def words(self):
+        return [f"tok{i} " for i in range(self.tokens)]
+
+
+def chunk(completion_id, model, content=None, finish_reason=None):
+    delta = {} if content is None else {"content": content}
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def create_app(model):
+    async def completions(request):
+        try:
+            body = await request.json()
+        except ClientDisconnect:
+            # A hedged call cancelled before it was sent in full
+            return Response(status_code=499)
+        model.requests += 1
+        name = body.get("model", "fake")
+        completion_id = f"chatcmpl-fake-{model.requests}"
+        words = model.words()
+
+        if not body.get("stream"):
+            await asyncio.sleep(model.delay(model.latency + len(words) / model.token_rate))
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": name,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words)}}],
+            })
+
+        async def stream():
+            await asyncio.sleep(model.first_token_delay())
+            first = chunk(completion_id, name)
+            first["choices"][0]["delta"] = {"role": "assistant", "content": ""}
+            yield f"data: {json.dumps(first)}\n\n"
+            for word in words:
+                yield f"data: {json.dumps(chunk(completion_id, name, word))}\n\n"
+                await asyncio.sleep(model.delay(1 / model.token_rate))
+            yield f"data: {json.dumps(chunk(completion_id, name, finish_reason='stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    async def models(request):
+        return JSONResponse({"object": "list", "data": [{"id": "gpt-4o-mini", "object": "model"}]})
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", completions, methods=["POST"]),
+        Route("/v1/models", models),
+    ])
+
+
+def add_model_args(parser):
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per reply")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative jitter on every delay")
+    parser.add_argument("--tail", type=float, default=0.0, help="fraction of replies with --tail-latency")
+    parser.add_argument("--tail-latency", type=float, default=2.0, help="seconds before the first token of slow replies")
+
+
+def model_from_args(args):
+    return FakeModel(args.tokens, args.token_rate, args.latency, args.jitter, tail=args.tail,
+                     tail_latency=args.tail_latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_model_args(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(model_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
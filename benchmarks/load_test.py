@@ -0,0 +1,218 @@
+"""Offline load test of the streaming chat path.
+
+Starts the local fake OpenAI server and the app (pointed at it through
+OPENAI_BASE_URL), then drives `--users` concurrent users for `--turns`
+turns each. Reports time to first token (from the moment the message is
+sent, i.e. the keypress), inter-token latency, per-reply tokens/s and
+total duration as p50/p95/p99, plus the app's event-loop lag and RSS.
+No network access or API key is needed.
+
+`--mode` picks the send path: "single" posts to /chat and reads the reply
+from the same response, "two" posts to /send_message and then opens
+/stream-response, and "both" runs one after the other for comparison.
+`--rtt-ms` adds a simulated network round trip to every request.
+
+    python benchmarks/load_test.py --users 50 --turns 3 --token-rate 80 --rtt-ms 80
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import httpx
+
+from fake_openai import add_model_args
+
+HERE = Path(__file__).resolve().parent
+MESSAGE_ID = re.compile(r'data-stream="([^"]+)"')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                await http.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{url} did not come up within {timeout}s")
+                await asyncio.sleep(0.1)
+
+
+class Results:
+    def __init__(self):
+        self.ttft = []
+        self.inter_token = []
+        self.tokens_per_s = []
+        self.duration = []
+        self.tokens = 0
+        self.errors = 0
+
+
+async def read_reply(lines, start, results):
+    """Consume SSE lines up to [DONE], recording token timings"""
+    first = last = None
+    tokens = 0
+    async for line in lines:
+        if not line.startswith("data: "):
+            continue
+        data = line[len("data: "):]
+        if data == "[DONE]":
+            break
+        event = json.loads(data)
+        if event["type"] == "error":
+            raise RuntimeError(event["content"])
+        if event["type"] == "chunk" and event["content"]:
+            now = time.perf_counter()
+            first = first or now
+            last = now
+            # The fake model emits one space-terminated word per token
+            tokens += event["content"].count(" ")
+
+    if first is None:
+        raise RuntimeError("reply had no content")
+    results.ttft.append(first - start)
+    results.duration.append(last - start)
+    results.tokens += tokens
+    if tokens > 1 and last > first:
+        results.inter_token.append((last - first) / (tokens - 1))
+        results.tokens_per_s.append(tokens / (last - first))
+
+
+async def run_turn_two(http, text, results, rtt):
+    """POST /send_message, then GET /stream-response: two round trips"""
+    start = time.perf_counter()
+    await asyncio.sleep(rtt)
+    resp = await http.post("/send_message", data={"message": text}, headers={"HX-Request": "true"})
+    resp.raise_for_status()
+    message_id = MESSAGE_ID.search(resp.text).group(1)
+
+    await asyncio.sleep(rtt)
+    async with http.stream("GET", "/stream-response", params={"message_id": message_id}) as stream:
+        await read_reply(stream.aiter_lines(), start, results)
+
+
+async def run_turn_single(http, text, results, rtt):
+    """POST /chat and read the reply from the same response: one round trip"""
+    start = time.perf_counter()
+    await asyncio.sleep(rtt)
+    async with http.stream("POST", "/chat", data={"message": text}) as stream:
+        stream.raise_for_status()
+        await read_reply(stream.aiter_lines(), start, results)
+
+
+TURNS = {"single": run_turn_single, "two": run_turn_two}
+
+
+async def run_user(base_url, n, args, mode, results):
+    run_turn = TURNS[mode]
+    async with httpx.AsyncClient(base_url=base_url, timeout=300) as http:
+        await http.get("/")
+        for turn in range(args.turns):
+            try:
+                await run_turn(http, f"User {n} {mode} question {turn}: what should I know?", results,
+                               args.rtt_ms / 1000)
+            except Exception as e:
+                results.errors += 1
+                print(f"user {n} turn {turn}: {e}", file=sys.stderr)
+
+
+def report(mode, results, elapsed, bench):
+    def row(name, values, scale=1000, unit="ms"):
+        print(f"  {name:<18} p50={percentile(values, 50) * scale:9.1f}{unit} "
+              f"p95={percentile(values, 95) * scale:9.1f}{unit} p99={percentile(values, 99) * scale:9.1f}{unit}")
+
+    replies = len(results.ttft)
+    print(f"[{mode}-request path]")
+    print(f"replies: {replies} ok, {results.errors} errors in {elapsed:.1f}s "
+          f"({replies / elapsed:.1f} replies/s, {results.tokens / elapsed:,.0f} tokens/s overall)")
+    row("ttft", results.ttft)
+    row("inter-token", results.inter_token)
+    row("reply duration", results.duration)
+    row("tokens/s per reply", results.tokens_per_s, scale=1, unit="")
+    lag = bench["lag_ms"]
+    print(f"  {'event-loop lag':<18} p50={lag['p50']:9.1f}ms p95={lag['p95']:9.1f}ms "
+          f"p99={lag['p99']:9.1f}ms max={lag['max']:.1f}ms")
+    print(f"  {'app rss':<18} {bench['rss_bytes'] / 2 ** 20:.1f}MiB")
+
+
+async def run(args):
+    fake_port, app_port = free_port(), free_port()
+    fake_url, app_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{app_port}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {
+            **os.environ,
+            "OPENAI_BASE_URL": f"{fake_url}/v1",
+            "OPENAI_API_KEY": "fake",
+            "CONVERSATION_DB": os.path.join(tmp, "conversations.db"),
+            "RESPONSE_CACHE_TTL": "0",
+        }
+        fake_cmd = [sys.executable, str(HERE / "fake_openai.py"), "--port", str(fake_port),
+                    "--tokens", str(args.tokens), "--token-rate", str(args.token_rate),
+                    "--latency", str(args.latency), "--jitter", str(args.jitter)]
+        app_cmd = [sys.executable, str(HERE / "serve_app.py"), "--port", str(app_port)]
+        procs = [subprocess.Popen(fake_cmd, env=env), subprocess.Popen(app_cmd, env=env, cwd=tmp)]
+        try:
+            await wait_ready(f"{fake_url}/v1/models")
+            await wait_ready(f"{app_url}/__bench")
+            modes = ["two", "single"] if args.mode == "both" else [args.mode]
+            for mode in modes:
+                async with httpx.AsyncClient() as http:
+                    await http.get(f"{app_url}/__bench", params={"reset": 1})
+
+                results = Results()
+                start = time.perf_counter()
+                users = []
+                for n in range(args.users):
+                    users.append(asyncio.create_task(run_user(app_url, n, args, mode, results)))
+                    if args.ramp:
+                        await asyncio.sleep(args.ramp / args.users)
+                await asyncio.gather(*users)
+                elapsed = time.perf_counter() - start
+
+                async with httpx.AsyncClient() as http:
+                    bench = (await http.get(f"{app_url}/__bench")).json()
+                report(mode, results, elapsed, bench)
+        finally:
+            for p in procs:
+                p.terminate()
+            for p in procs:
+                p.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--turns", type=int, default=3, help="messages sent by each user")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which users start")
+    parser.add_argument("--mode", choices=["single", "two", "both"], default="both",
+                        help="send path: one request (/chat), two requests (/send_message + /stream-response), or both")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="simulated network round trip per request")
+    add_model_args(parser)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
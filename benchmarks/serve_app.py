@@ -0,0 +1,76 @@
+"""Run the chat app for load tests, with event-loop lag and RSS probes.
+
+Adds a `/__bench` route reporting event-loop lag percentiles and resident
+memory. `?reset=1` clears the lag samples so each run is measured alone.
+
+    python benchmarks/serve_app.py --port 5001
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import resource
+from pathlib import Path
+
+import uvicorn
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import main
+
+LAG_INTERVAL = 0.01
+lag_samples = []
+
+
+async def sample_lag():
+    """Measure how late the loop wakes from a short sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag_samples.append(loop.time() - start - LAG_INTERVAL)
+
+
+async def start_lag_sampler():
+    main.app.state.lag_task = asyncio.create_task(sample_lag())
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+main.app.on_event("startup")(start_lag_sampler)
+
+
+@main.rt('/__bench')
+def bench_stats(reset: bool = False):
+    samples = list(lag_samples)
+    if reset:
+        lag_samples.clear()
+    return {
+        "time": time.time(),
+        "rss_bytes": rss_bytes(),
+        "lag_ms": {f"p{p}": percentile(samples, p) * 1000 for p in (50, 95, 99)}
+                  | {"max": max(samples, default=0) * 1000, "samples": len(samples)},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    args = parser.parse_args()
+    uvicorn.run(main.app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,228 @@
+import time
+import uuid
+import queue
+import asyncio
+import sqlite3
+import threading
+
+from streaming import SSE_DONE, SSE_KEEPALIVE, sse_event
+
+
+class StreamBroker:
+    """Response streams shared between worker processes.
+
+    The worker generating a reply `claim`s its key, then `publish`es every
+    formatted SSE event in id order, the last one with `done`. Any worker
+    can `subscribe` to a claimed key from a `Last-Event-ID` and relay the
+    events to its own client. While it does, `watched` tells the producer
+    that someone is still reading, so the upstream call is not cancelled.
+    The operations map onto a Redis stream (XADD/XREAD) plus a key per
+    stream, so a networked implementation can replace the SQLite one.
+    """
+
+    def claim(self, key):
+        """Register `key` for this process; False if another process already has"""
+        return True
+
+    def exists(self, key):
+        return False
+
+    def publish(self, key, event_id, event, done=False):
+        pass
+
+    def watched(self, key):
+        """True if some other process relayed `key` recently"""
+        return False
+
+    async def subscribe(self, key, last_id=0, heartbeat=None):
+        return
+        yield
+
+    def close(self):
+        pass
+
+
+class SQLiteBroker(StreamBroker):
+    """Stream broker on a SQLite file shared by the workers on one host.
+
+    Writes are queued and committed in small batches by a background
+    thread, which also renews this process's lease on the streams it owns
+    and keeps a copy of when each of them was last relayed, so `watched`
+    does not touch the file. Subscribers poll for new events every
+    `poll_interval` seconds, in a thread. `claim` and `exists` can wait on
+    another process's write, so async callers run them in a thread too. A
+    stream whose owner stops renewing for `lease` seconds (the worker
+    died) ends with an error, and streams are deleted `ttl` seconds after
+    they stop.
+    """
+
+    def __init__(self, path, ttl=60.0, lease=10.0, poll_interval=0.02, batch_delay=0.005, watch_interval=1.0):
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.batch_delay = batch_delay
+        self.watch_interval = watch_interval
+        self.owner = uuid.uuid4().hex
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # Last relayed time of this process's live streams, refreshed by the writer
+        self._watched = {}
+
+        db = self._connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS streams ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0, "
+            "last_id INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL, watched REAL NOT NULL DEFAULT 0)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS stream_events ("
+            "key TEXT NOT NULL, id INTEGER NOT NULL, event TEXT NOT NULL, "
+            "PRIMARY KEY (key, id)) WITHOUT ROWID"
+        )
+        db.commit()
+        # Claims and reads; the writer thread has its own connection
+        self._db = db
+
+        self._writer = threading.Thread(target=self._write_loop, name="stream-broker", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def claim(self, key):
+        # Synchronous, so two workers racing to start the same reply agree on one
+        with self._lock, self._db:
+            return self._db.execute(
+                "INSERT OR IGNORE INTO streams (key, owner, updated) VALUES (?, ?, ?)",
+                (key, self.owner, time.time()),
+            ).rowcount == 1
+
+    def exists(self, key):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM streams WHERE key = ?", (key,)).fetchone() is not None
+
+    def publish(self, key, event_id, event, done=False):
+        self._queue.put(("event", key, event_id, event, done))
+
+    def watched(self, key):
+        return self._watched.get(key, 0) > time.time() - 3 * self.watch_interval
+
+    def _poll(self, key, cursor):
+        """Events after `cursor`, and the stream's (done, last_id, updated) or None if it expired"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, event FROM stream_events WHERE key = ? AND id > ? ORDER BY id",
+                (key, cursor),
+            ).fetchall()
+            state = self._db.execute("SELECT done, last_id, updated FROM streams WHERE key = ?",
+                                     (key,)).fetchone()
+        return rows, state
+
+    async def subscribe(self, key, last_id=0, heartbeat=None):
+        """Yield formatted events after `last_id` until the stream's [DONE]"""
+        cursor = last_id
+        idle_since = time.monotonic()
+        watched_at = 0.0
+        while True:
+            rows, state = await asyncio.to_thread(self._poll, key, cursor)
+            for event_id, event in rows:
+                cursor = event_id
+                yield event
+            now = time.monotonic()
+            if rows:
+                idle_since = now
+            if state is None:
+                return  # expired
+            done, final_id, updated = state
+            if done and cursor >= final_id:
+                return
+            if not done and updated < time.time() - self.lease:
+                yield sse_event({"type": "error", "content": "The worker generating this response stopped."})
+                yield SSE_DONE
+                return
+            if now - watched_at >= self.watch_interval:
+                watched_at = now
+                self._queue.put(("watch", key))
+            if heartbeat is not None and now - idle_since >= heartbeat:
+                idle_since = now
+                yield SSE_KEEPALIVE
+            await asyncio.sleep(self.poll_interval)
+
+    def flush(self):
+        """Block until every queued write has been committed"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        with self._lock:
+            self._db.close()
+
+    def _write_loop(self):
+        db = self._connect()
+        renew_every = self.lease / 5
+        renewed = swept = read = 0.0
+        try:
+            while True:
+                try:
+                    batch = [self._queue.get(timeout=min(renew_every, self.watch_interval))]
+                except queue.Empty:
+                    batch = []
+                # Gather whatever else arrives within the batch window
+                deadline = time.monotonic() + self.batch_delay
+                try:
+                    while batch and batch[-1] is not None:
+                        batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    pass
+
+                stop = bool(batch) and batch[-1] is None
+                now = time.time()
+                try:
+                    with db:
+                        self._write(db, [item for item in batch if item is not None], now)
+                        if now - renewed >= renew_every:
+                            renewed = now
+                            db.execute("UPDATE streams SET updated = ? WHERE owner = ? AND done = 0",
+                                       (now, self.owner))
+                        if now - swept >= self.ttl / 4:
+                            swept = now
+                            self._sweep(db, now)
+                    if now - read >= self.watch_interval:
+                        read = now
+                        self._watched = dict(db.execute(
+                            "SELECT key, watched FROM streams WHERE owner = ? AND done = 0", (self.owner,)
+                        ))
+                except sqlite3.Error as e:
+                    print(f"Stream broker error: {e}")
+                for _ in batch:
+                    self._queue.task_done()
+                if stop:
+                    break
+        finally:
+            db.close()
+
+    def _write(self, db, items, now):
+        events = [item[1:4] for item in items if item[0] == "event"]
+        if events:
+            db.executemany("INSERT OR IGNORE INTO stream_events (key, id, event) VALUES (?, ?, ?)", events)
+        # Latest event of each stream in this batch; items are queued in id order
+        latest = {item[1]: (item[2], int(item[4])) for item in items if item[0] == "event"}
+        db.executemany(
+            "INSERT INTO streams (key, owner, done, last_id, updated) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET done = excluded.done, last_id = excluded.last_id, "
+            "updated = excluded.updated",
+            [(key, self.owner, done, event_id, now) for key, (event_id, done) in latest.items()],
+        )
+        watched = {item[1] for item in items if item[0] == "watch"}
+        db.executemany("UPDATE streams SET watched = ? WHERE key = ?", [(now, key) for key in watched])
+
+    def _sweep(self, db, now):
+        # Live streams are renewed by their owner, so only finished or orphaned ones are this old
+        cutoff = now - self.ttl
+        db.execute("DELETE FROM stream_events WHERE key IN (SELECT key FROM streams WHERE updated < ?)", (cutoff,))
+        db.execute("DELETE FROM streams WHERE updated < ?", (cutoff,))
@@ -0,0 +1,112 @@
+import time
+import asyncio
+
+from context import compaction_point
+
+
+class Compactor:
+    """Folds the oldest turns of long conversations into a summary, off the request path.
+
+    `schedule` is called once a reply has finished streaming. Calls for a
+    session within `delay` seconds of the first are merged, so a burst of
+    quick replies leads to at most one summarization, which reads the
+    history as it is when it starts. Work is due once the unsummarized
+    history passes `threshold` tokens; `summarize(previous, messages)`
+    then returns a summary extending `previous` with the oldest messages,
+    leaving the newest `keep` tokens verbatim. A summary only ever moves
+    forward, so running the same compaction twice, here or in another
+    process, changes nothing. At most `max_concurrent` summarizations run
+    at a time, separately from the upstream scheduler, so live replies
+    never wait behind them.
+    """
+
+    def __init__(self, store, summarize, threshold, keep, delay=5.0, max_concurrent=2, on_done=None,
+                 on_error=None):
+        self.store = store
+        self.summarize = summarize
+        self.threshold = threshold
+        self.keep = keep
+        self.delay = delay
+        self.on_done = on_done
+        self.on_error = on_error
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._timers = {}
+        self._running = {}
+        self._again = set()
+        self._closed = False
+        self.runs = 0
+        self.compactions = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def schedule(self, session_id):
+        """Compact `session_id` after the debounce delay, if it is due by then"""
+        if not self.enabled or self._closed or session_id in self._timers:
+            return
+        if session_id in self._running:
+            # Look again once the running compaction finishes
+            self._again.add(session_id)
+            return
+        self._timers[session_id] = asyncio.get_running_loop().call_later(self.delay, self._start, session_id)
+
+    def _start(self, session_id):
+        del self._timers[session_id]
+        self._running[session_id] = asyncio.create_task(self._run(session_id))
+
+    async def _run(self, session_id):
+        try:
+            async with self._slots:
+                await self._compact(session_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            print(f"Compaction error: {e}")
+            if self.on_error is not None:
+                self.on_error(e)
+        finally:
+            del self._running[session_id]
+            if session_id in self._again:
+                self._again.discard(session_id)
+                self.schedule(session_id)
+
+    async def _compact(self, session_id):
+        self.runs += 1
+        summary = await asyncio.to_thread(self.store.refresh_summary, session_id)
+        summarized = summary[0] if summary else 0
+        history = await asyncio.to_thread(self.store.history, session_id)
+        upto = compaction_point(history, summarized, self.threshold, self.keep)
+        if upto is None:
+            return
+
+        started = time.perf_counter()
+        messages = [m for m in history if summarized < m.seq <= upto]
+        text = await self.summarize(summary[1] if summary else None, messages)
+        if await asyncio.to_thread(self.store.set_summary, session_id, upto, text):
+            self.compactions += 1
+            if self.on_done is not None:
+                self.on_done(time.perf_counter() - started)
+
+    async def close(self):
+        """Drop pending compactions, and cancel running ones and wait until they have stopped"""
+        self._closed = True
+        for handle in self._timers.values():
+            handle.cancel()
+        self._timers.clear()
+        self._again.clear()
+        running = list(self._running.values())
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "pending": len(self._timers),
+            "running": len(self._running),
+            "runs": self.runs,
+            "compactions": self.compactions,
+            "errors": self.errors,
+        }
@@ -0,0 +1,69 @@
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken is optional; fall back to a character estimate
+    _encoding = None
+
+# Per-message framing tokens added by the chat format (role, separators)
+MESSAGE_OVERHEAD = 4
+
+
+def count_tokens(text):
+    """Count tokens in `text`, exactly with tiktoken or estimated at ~4 chars/token"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def message_tokens(record):
+    """Token cost of a stored message, computed once and cached on the record"""
+    if record.tokens is None:
+        record.tokens = count_tokens(record.message) + MESSAGE_OVERHEAD
+    return record.tokens
+
+
+def window_start(history, start_seq, budget, evict_block):
+    """Return the seq the context window should start at.
+
+    The window only moves forward, and only when the messages from
+    `start_seq` onwards no longer fit in `budget`. It then jumps far enough
+    to free `evict_block` tokens of headroom, so the prompt prefix stays
+    byte-identical for the following turns and provider prefix caching hits.
+    The first message (greeting) is pinned and does not count against the
+    window; the latest message is always kept.
+    """
+    window = [m for m in history if m.seq >= start_seq and m.seq != 0]
+    total = sum(message_tokens(m) for m in window)
+    if total <= budget:
+        return start_seq
+
+    target = max(budget - evict_block, 0)
+    i = 0
+    while total > target and i < len(window) - 1:
+        total -= message_tokens(window[i])
+        i += 1
+    return window[i].seq
+
+
+def compaction_point(history, summarized, threshold, keep):
+    """Return the last seq to fold into the summary, or None if none is due.
+
+    `summarized` is the last seq the current summary covers. Compaction is
+    due once the messages after it exceed `threshold` tokens. The newest
+    messages, up to `keep` tokens, stay verbatim, starting at a user message
+    so a turn is never split; the latest turn is always kept.
+    """
+    pending = [m for m in history if m.seq > summarized and m.seq != 0]
+    if sum(message_tokens(m) for m in pending) <= threshold:
+        return None
+
+    i = len(pending)
+    kept = 0
+    while i > 0 and kept + message_tokens(pending[i - 1]) <= keep:
+        i -= 1
+        kept += message_tokens(pending[i])
+    while i < len(pending) and pending[i].sender != "user":
+        i += 1
+    if i == len(pending):
+        i = max((j for j, m in enumerate(pending) if m.sender == "user"), default=0)
+    return pending[i - 1].seq if i > 0 else None
@@ -0,0 +1,351 @@
+import sys
+import time
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+from persistence import ConversationBackend, SeqTaken
+from search import parse_query
+
+
+class Message:
+    """Compact record for a single chat message"""
+    __slots__ = ("seq", "sender", "message", "tokens")
+
+    def __init__(self, seq, sender, message, tokens=None):
+        self.seq = seq
+        self.sender = sender
+        self.message = message
+        self.tokens = tokens
+
+    @property
+    def nbytes(self):
+        return _RECORD_OVERHEAD + sys.getsizeof(self.message)
+
+
+def _seq(record):
+    return record.seq
+
+
+# Approximate resident cost of a Message record excluding its text
+_RECORD_OVERHEAD = sys.getsizeof(Message(0, "ai", None)) + sys.getsizeof(0)
+
+
+class Conversation:
+    """Message history for one session"""
+    __slots__ = ("session_id", "messages", "nbytes", "next_seq", "last_used", "context_start", "summary")
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.messages = []
+        self.nbytes = 0
+        self.next_seq = 0
+        self.last_used = time.monotonic()
+        # First seq sent upstream; advanced in blocks to keep the prompt prefix stable
+        self.context_start = 0
+        # (upto_seq, text) summarizing the messages up to upto_seq, or None
+        self.summary = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+
+class ConversationStore:
+    """Session-keyed conversation histories with a global memory ceiling.
+
+    Conversations are kept in LRU order. Idle conversations are dropped after
+    `idle_ttl` seconds, and the least recently used ones are evicted whenever
+    the resident size exceeds `max_bytes`. All mutations take a single lock so
+    appends from overlapping streams never interleave.
+
+    Every appended message is also handed to `backend` for durable storage.
+    A conversation that is not resident is cold-loaded from the backend with
+    only its most recent `max_messages` messages. When the backend is shared
+    with other worker processes, a resident conversation catches up as soon
+    as the backend holds messages it has not seen: only those are loaded, so
+    its context window and cached token counts carry over.
+    """
+
+    def __init__(self, greeting=None, max_bytes=64 * 1024 * 1024, idle_ttl=24 * 3600, max_messages=200, trim_block=50,
+                 backend=None):
+        self.backend = backend or ConversationBackend()
+        self.greeting = greeting
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self.trim_block = trim_block
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._evictions = 0
+
+    def get(self, session_id):
+        """Return the conversation for `session_id`, loading or creating it if needed"""
+        loaded = self._load(session_id)
+        with self._lock:
+            return self._touch(session_id, loaded)
+
+    def append(self, session_id, sender, message):
+        """Append a message to a session's history and return the stored record"""
+        if self.backend.shared:
+            return self._append_shared(session_id, sender, message)
+        loaded = self._load(session_id)
+        with self._lock:
+            conv = self._touch(session_id, loaded)
+            record = self._add(conv, sender, message)
+            self.backend.append(session_id, record.seq, sender, message)
+            self._trim(conv)
+            self._evict()
+            return record
+
+    def _append_shared(self, session_id, sender, message, attempts=5):
+        # The commit happens outside the lock; if another worker took the seq
+        # first, forget ours, catch up with its message and append after it
+        for _ in range(attempts):
+            loaded = self._load(session_id)
+            with self._lock:
+                conv = self._touch(session_id, loaded)
+                record = self._add(conv, sender, message)
+            try:
+                self.backend.append(session_id, record.seq, sender, message)
+            except SeqTaken:
+                with self._lock:
+                    self._truncate(conv, bisect_left(conv.messages, record.seq, key=_seq))
+                    conv.next_seq = record.seq
+                continue
+            with self._lock:
+                self._trim(conv)
+                self._evict()
+            return record
+        raise SeqTaken(session_id, record.seq)
+
+    def set_summary(self, session_id, upto_seq, summary):
+        """Store a summary of the messages up to `upto_seq`, unless a newer one exists"""
+        conv = self.get(session_id)
+        with self._lock:
+            if conv.summary is not None and conv.summary[0] >= upto_seq:
+                return False
+            self._summarize(conv, (upto_seq, summary))
+        self.backend.save_summary(session_id, upto_seq, summary)
+        return True
+
+    def refresh_summary(self, session_id):
+        """Adopt a newer summary stored by another process, and return the current one"""
+        conv = self.get(session_id)
+        stored = self.backend.load_summary(session_id)
+        with self._lock:
+            if stored is not None and (conv.summary is None or stored[0] > conv.summary[0]):
+                self._summarize(conv, tuple(stored))
+            return conv.summary
+
+    def awaiting_reply(self, session_id):
+        """Seq of the reply the latest message still waits for, or None if that message is not the user's"""
+        conv = self.get(session_id)
+        with self._lock:
+            last = conv.messages[-1] if conv.messages else None
+            return last.seq + 1 if last is not None and last.sender == "user" else None
+
+    def history(self, session_id):
+        """Snapshot of a session's messages, safe to iterate while others append"""
+        return list(self.get(session_id).messages)
+
+    def page(self, session_id, before=None, limit=20):
+        """Return a page of history and the cursor for the next older page.
+
+        The page holds up to `limit` messages with seq below `before` (the
+        newest messages when `before` is None). It is served from memory when
+        resident and from the backend otherwise. The greeting is included on
+        the oldest page, where the returned cursor is None.
+        """
+        conv = self.get(session_id)
+        first_seq = 0 if self.greeting is None else 1
+        with self._lock:
+            # Everything after the pinned greeting is a contiguous run of seqs
+            body = conv.messages[first_seq:]
+            greeting = conv.messages[0] if first_seq else None
+            if before is None:
+                before = conv.next_seq
+            resident_from = body[0].seq if body else conv.next_seq
+            if before - limit >= resident_from or resident_from <= first_seq:
+                end = bisect_left(body, before, key=_seq)
+                page = body[max(end - limit, 0):end]
+            else:
+                page = None
+
+        if page is None:
+            page = [Message(*row) for row in self.backend.load_recent(session_id, limit, before)]
+
+        if not page or page[0].seq <= first_seq:
+            return ([greeting] if greeting else []) + page, None
+        return page, page[0].seq
+
+    def around(self, session_id, seq, limit=20):
+        """Return a page of history centred on `seq`, and the cursors for the
+        older and the newer pages next to it (None at either end)"""
+        page, older = self.page(session_id, seq + limit // 2 + 1, limit)
+        next_seq = self.get(session_id).next_seq
+        return page, older, (page[-1].seq if page and page[-1].seq + 1 < next_seq else None)
+
+    def newer(self, session_id, after, limit=20):
+        """Return up to `limit` messages with seq above `after`, and the cursor
+        for the page after them (None once the latest message is included)"""
+        next_seq = self.get(session_id).next_seq
+        end = min(after + limit + 1, next_seq)
+        if end <= after + 1:
+            return [], None
+        page, _ = self.page(session_id, end, end - after - 1)
+        page = [msg for msg in page if msg.seq > after]
+        return page, (page[-1].seq if page and end < next_seq else None)
+
+    def search(self, session_id, query, limit=20, offset=0):
+        """Messages of a session matching a search box `query`, best match first.
+
+        Returns (seq, sender, snippet) tuples from the backend's index; see
+        `search.parse_query` for the query syntax. Appends still waiting
+        for the backend's writer are not found yet.
+        """
+        terms = parse_query(query)
+        if not terms:
+            return []
+        return self.backend.search(session_id, terms, limit, offset)
+
+    def drop(self, session_id):
+        with self._lock:
+            conv = self._sessions.pop(session_id, None)
+            if conv is not None:
+                self._bytes -= conv.nbytes
+
+    def close(self):
+        """Flush pending writes and release the backend"""
+        self.backend.close()
+
+    def stats(self):
+        """Resident sessions, messages and bytes for capacity planning"""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "messages": sum(len(c) for c in self._sessions.values()),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+            }
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def _load(self, session_id):
+        # Cold load happens outside the lock so a disk read never stalls other sessions
+        conv = self._sessions.get(session_id)
+        limit = self.max_messages
+        if conv is not None:
+            if not self.backend.shared:
+                return None
+            latest = self.backend.latest_seq(session_id)
+            if latest is None or latest < conv.next_seq:
+                return None
+            # Another worker has appended since; fetch only what this copy lacks
+            limit = min(latest - conv.next_seq + 1, limit)
+        return self.backend.load_recent(session_id, limit), self.backend.load_summary(session_id)
+
+    # Internal helpers; callers must hold self._lock
+
+    def _touch(self, session_id, loaded=None):
+        conv = self._sessions.get(session_id)
+        now = time.monotonic()
+        if conv is None:
+            conv = Conversation(session_id)
+            self._sessions[session_id] = conv
+            # The greeting is constant, so it is pinned at seq 0 and never persisted
+            if self.greeting is not None:
+                self._add(conv, "ai", self.greeting)
+            if loaded is not None:
+                self._merge(conv, *loaded)
+            self._expire(now)
+            self._evict()
+        else:
+            self._sessions.move_to_end(session_id)
+            if loaded is not None:
+                self._merge(conv, *loaded)
+                self._trim(conv)
+                self._evict()
+        conv.last_used = now
+        return conv
+
+    def _merge(self, conv, rows, summary):
+        """Add stored (seq, sender, message) rows newer than the resident
+        messages, and adopt a stored summary newer than the resident one"""
+        rows = [row for row in rows if row[0] >= conv.next_seq]
+        if rows and rows[0][0] > conv.next_seq:
+            # Too far behind to stay contiguous; older pages come from the backend
+            self._truncate(conv, 0 if self.greeting is None else 1)
+        for seq, sender, message in rows:
+            conv.next_seq = seq
+            self._add(conv, sender, message)
+        if summary is not None and (conv.summary is None or summary[0] > conv.summary[0]):
+            self._summarize(conv, tuple(summary))
+
+    def _truncate(self, conv, keep):
+        """Forget all but the first `keep` messages"""
+        dropped = conv.messages[keep:]
+        del conv.messages[keep:]
+        freed = sum(m.nbytes for m in dropped)
+        conv.nbytes -= freed
+        self._bytes -= freed
+
+    def _add(self, conv, sender, message):
+        record = Message(conv.next_seq, sender, message)
+        conv.next_seq += 1
+        conv.messages.append(record)
+        conv.nbytes += record.nbytes
+        self._bytes += record.nbytes
+        return record
+
+    def _summarize(self, conv, summary):
+        size = sys.getsizeof(summary[1]) - (sys.getsizeof(conv.summary[1]) if conv.summary else 0)
+        conv.summary = summary
+        conv.nbytes += size
+        self._bytes += size
+
+    def _trim(self, conv):
+        """Keep the greeting, if there is one, and the most recent messages.
+
+        Trims a whole block at a time so the retained history (and with it the
+        upstream prompt prefix) changes rarely rather than on every turn.
+        """
+        if len(conv.messages) <= self.max_messages:
+            return
+        first = 0 if self.greeting is None else 1
+        excess = len(conv.messages) - self.max_messages + self.trim_block
+        dropped = conv.messages[first:first + excess]
+        del conv.messages[first:first + excess]
+        freed = sum(m.nbytes for m in dropped)
+        conv.nbytes -= freed
+        self._bytes -= freed
+
+    def _expire(self, now):
+        cutoff = now - self.idle_ttl
+        while self._sessions:
+            conv = next(iter(self._sessions.values()))
+            if conv.last_used >= cutoff:
+                break
+            self._pop_oldest()
+
+    def _evict(self):
+        # Never evict the most recently used session, even if it alone is over budget
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            self._pop_oldest()
+
+    def _pop_oldest(self):
+        _, conv = self._sessions.popitem(last=False)
+        self._bytes -= conv.nbytes
+        self._evictions += 1
@@ -0,0 +1,72 @@
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+from fastcore.xml import to_xml
+
+
+def content_hash(*parts):
+    """Short digest identifying a fragment's inputs"""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class FragmentCache:
+    """LRU cache of rendered HTML for finished chat messages.
+
+    Entries are the serialized HTML of a component, so a hit skips both
+    building the FT tree and rendering it. The cache is bounded by
+    `max_bytes` and lives in memory only: the theme and CSS are read at
+    startup, so a restyle takes effect on restart, with an empty cache.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def render(self, key, build):
+        """Return the HTML string for `key`, rendering `build()` on a miss.
+
+        `build()` returns a component, or an HTML string that is used as is.
+        """
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        html = build()
+        if not isinstance(html, str):
+            html = to_xml(html, indent=False)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = html
+                self._bytes += sys.getsizeof(html)
+                while self._bytes > self.max_bytes and len(self._entries) > 1:
+                    _, old = self._entries.popitem(last=False)
+                    self._bytes -= sys.getsizeof(old)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
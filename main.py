@@ -3,88 +3,30 @@ from fasthtml.svg import *
 from fasthtml.components import Zero_md
 import os
 import json
+import uuid
+import time
+import asyncio
+from urllib.parse import urlencode
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAIError
-from starlette.responses import StreamingResponse
+from openai import OpenAIError
+from starlette.responses import PlainTextResponse, StreamingResponse
+from conversations import ConversationStore
+from persistence import SQLiteBackend
+from search import snippet_html
+from context import window_start
+from compaction import Compactor
+from response_cache import ResponseCache, cache_key, replay_chunks
+from streaming import SSE_DONE, ResponseStreams, coalesce, sse_event
+from broker import SQLiteBroker
+from fragments import FragmentCache, content_hash
+from assets import PrecompressedFiles, VersionedFiles, load_manifest
+import rendering
+from metrics import Registry
+from scheduler import UpstreamScheduler
+from upstream import Endpoint, OpenAIBackend
 
 load_dotenv()
 
-# Initialize async OpenAI client
-client = AsyncOpenAI()
-
-# Custom CSS for scrollbar and Inter font
-custom_css = Style("""
-body { font-family: 'Inter', sans-serif; }
-::-webkit-scrollbar { width: 6px; }
-::-webkit-scrollbar-track { background: #2d3748; }
-::-webkit-scrollbar-thumb { background: #4a5568; border-radius: 3px; }
-::-webkit-scrollbar-thumb:hover { background: #718096; }
-textarea { resize: none; }
-.htmx-indicator { opacity: 0; transition: opacity 200ms ease-in; }
-.htmx-request .htmx-indicator { opacity: 1; }
-button:disabled { opacity: 0.5; cursor: not-allowed; }
-button:disabled:hover { background-color: inherit !important; }
-""")
-
-hdrs = (
-    Script(src="https://cdn.jsdelivr.net/npm/@tailwindcss/browser@4"),
-    Script(type="module", src="https://cdn.jsdelivr.net/npm/zero-md@3?register"),
-    HighlightJS(langs=['python', 'javascript', 'html', 'css', 'bash', 'json', 'yaml', 'markdown']),
-    Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/katex.min.css"),
-    Script(src="https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/katex.min.js"),
-    Script(src="https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/contrib/auto-render.min.js", onload="window.katexLoaded = true;"),
-    custom_css,
-)
-app, rt = fast_app(hdrs=hdrs, pico=False)
-
-# Configuration
-MAX_MESSAGES = 50
-
-messages = [
-    {"sender": "ai", "message": "Hello! I'm here to assist with your business needs. How can I help you today?"}
-]
-
-def manage_conversation_memory():
-    """Keep conversation within memory limits"""
-    global messages
-    if len(messages) > MAX_MESSAGES:
-        # Keep the first message (greeting) and the most recent messages
-        messages = [messages[0]] + messages[-(MAX_MESSAGES-1):]
-
-def build_api_messages(user_message, conversation_history):
-    """Helper function to build API messages array"""
-    api_messages = []
-    
-    # Add system message for business assistant context
-    api_messages.append({
-        "role": "system",
-        "content": "You are a helpful business assistant. Be professional, friendly, and concise in your responses."
-    })
-    
-    # Add conversation history
-    for msg in conversation_history:
-        role = "assistant" if msg["sender"] == "ai" else "user"
-        api_messages.append({
-            "role": role,
-            "content": msg["message"]
-        })
-    
-    # Add current user message
-    api_messages.append({
-        "role": "user",
-        "content": user_message
-    })
-    
-    return api_messages
-
-def render_md(md, css='', **kwargs):
-    """Simple markdown renderer using zero-md"""
-    if css:
-        css_template = Template(Style(css), data_append=True)
-        return Zero_md(css_template, Script(md, type="text/markdown"), **kwargs)
-    else:
-        return Zero_md(Script(md, type="text/markdown"), **kwargs)
-
 # Dark theme CSS for zero-md with HighlightJS integration and KaTeX
 dark_md_css = '''
 .markdown-body {
@@ -120,28 +62,420 @@ dark_md_css = '''
 }
 '''
 
-async def get_ai_response_streaming_async(user_message, conversation_history):
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# Output of `python assets.py`; when it exists, front-end assets are served
+# from /assets instead of the CDNs
+ASSET_DIST = os.getenv("ASSET_DIST", os.path.join(STATIC_DIR, "dist"))
+asset_manifest = load_manifest(ASSET_DIST)
+# "server" renders answers to HTML as they stream, a finished block at a time,
+# with code highlighted and math as MathML; "client" leaves it to zero-md.
+# Server rendering needs markdown-it-py (`uv sync --extra rendering` installs it with
+# pygments and latex2mathml).
+MARKDOWN_RENDERING = os.getenv("MARKDOWN_RENDERING", "server" if rendering.AVAILABLE else "client")
+SERVER_MARKDOWN = MARKDOWN_RENDERING == "server" and rendering.AVAILABLE
+CODE_CSS = rendering.code_css() if SERVER_MARKDOWN else ""
+
+def read_static(name):
+    with open(os.path.join(STATIC_DIR, name)) as f:
+        return f.read()
+
+def static_url(name):
+    """URL of a file in static/, versioned by content so browsers can cache it"""
+    return f"/static/{name}?v={content_hash(read_static(name))[:12]}"
+
+def zero_md_setup(src):
+    """Register zero-md with the dark theme appended to its template once per page,
+    rather than shipping the stylesheet inside every message"""
+    return Script(f"""
+import ZeroMd from '{src}';
+customElements.define('zero-md', class extends ZeroMd {{
+    async load() {{
+        await super.load();
+        this.template += {json.dumps('<style>' + dark_md_css + '</style>')};
+    }}
+}});
+""", type="module")
+
+def markdown_hdrs(zero_md_src):
+    if SERVER_MARKDOWN:
+        return (Link(rel="stylesheet", href=f"/code-theme?v={content_hash(CODE_CSS)[:12]}"),)
+    return (zero_md_setup(zero_md_src),)
+
+def cdn_hdrs():
+    # Tailwind compiles in the browser here; app.css and chat.js are still local
+    return (
+        Script(src="https://cdn.jsdelivr.net/npm/@tailwindcss/browser@4"),
+        *markdown_hdrs("https://cdn.jsdelivr.net/npm/zero-md@3"),
+        HighlightJS(langs=['python', 'javascript', 'html', 'css', 'bash', 'json', 'yaml', 'markdown']),
+        Link(rel="stylesheet", href="https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/katex.min.css"),
+        Script(src="https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/katex.min.js"),
+        Script(src="https://cdn.jsdelivr.net/npm/katex@0.16.22/dist/contrib/auto-render.min.js", onload="window.katexLoaded = true;"),
+        Link(rel="stylesheet", href=static_url("app.css")),
+        Script(src=static_url("chat.js"), defer=True),
+    )
+
+def local_hdrs(manifest):
+    # Precompiled and vendored; only stylesheets block rendering
+    url = lambda name: f"/assets/{manifest[name]}"
+    return (
+        Link(rel="stylesheet", href=url("app.css")),
+        Link(rel="stylesheet", href=url("katex.css")),
+        Link(rel="stylesheet", href=url("highlight-dark.css"), media="(prefers-color-scheme: dark)"),
+        Link(rel="stylesheet", href=url("highlight-light.css"), media="(prefers-color-scheme: light)"),
+        Script(src=url("htmx.js"), defer=True),
+        Script(src=url("fasthtml.js"), defer=True),
+        Script(src=url("highlight.js"), defer=True),
+        Script(src=url("katex.js"), defer=True, onload="window.katexLoaded = true;"),
+        Script("""
+hljs.addPlugin(new CopyButtonPlugin());
+hljs.configure({'cssSelector': 'pre code:not([data-highlighted="yes"])'});
+htmx.onLoad(hljs.highlightAll);""", type="module"),
+        *markdown_hdrs(url("zero-md.js")),
+        Script(src=url("chat.js"), defer=True),
+    )
+
+def session_secret(path=".sesskey"):
+    """Key that signs session cookies, created once and shared by every worker.
+
+    Workers start at the same time, so the file is written under a temporary
+    name and linked into place; whichever link lands first wins.
+    """
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            f.write(str(uuid.uuid4()))
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(path) as f:
+        return f.read()
+
+if asset_manifest is None:
+    app, rt = fast_app(hdrs=cdn_hdrs(), pico=False, surreal=False, secret_key=session_secret())
+else:
+    app, rt = fast_app(hdrs=local_hdrs(asset_manifest), pico=False, surreal=False, htmx=False,
+                       secret_key=session_secret())
+    # Ahead of the catch-all static route, which would otherwise serve these uncompressed
+    app.routes.insert(0, Mount("/assets", PrecompressedFiles(directory=ASSET_DIST), name="assets"))
+# From this directory rather than the catch-all route's, which is relative to where the app starts
+app.routes.insert(0, Mount("/static", VersionedFiles(directory=STATIC_DIR), name="static"))
+
+# Configuration
+MAX_MESSAGES = 200
+# Messages rendered per history page
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))
+# Results per page of /search, which needs CONVERSATION_DB for its index
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+# Newest matches of a search that are ranked; older ones follow, newest first
+SEARCH_MAX_RANKED = int(os.getenv("SEARCH_MAX_RANKED", 200))
+# Tokens of history sent upstream, and how much headroom to free when it overflows
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 8000))
+CONTEXT_EVICT_BLOCK = CONTEXT_TOKEN_BUDGET // 4
+# Once the unsummarized history passes this many tokens, its oldest turns are
+# summarized in the background and the newest COMPACTION_KEEP_TOKENS are kept
+# verbatim (0 disables)
+COMPACTION_THRESHOLD = int(os.getenv("COMPACTION_THRESHOLD", CONTEXT_TOKEN_BUDGET * 3 // 4))
+COMPACTION_KEEP_TOKENS = int(os.getenv("COMPACTION_KEEP_TOKENS", CONTEXT_TOKEN_BUDGET // 4))
+# Replies finishing within this many seconds of the first share one compaction
+COMPACTION_DELAY = float(os.getenv("COMPACTION_DELAY", 5))
+COMPACTION_SUMMARY_TOKENS = 400
+MAX_CONVERSATION_BYTES = int(os.getenv("MAX_CONVERSATION_BYTES", 64 * 1024 * 1024))
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", 24 * 3600))
+# SQLite file conversations are persisted to; set to an empty string to keep them in memory only
+CONVERSATION_DB = os.getenv("CONVERSATION_DB", "conversations.db")
+# Seconds a completed response may be replayed for an identical prompt (0 disables)
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+# Optional SQLite file so cached responses survive restarts
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", 256 * 1024 * 1024))
+
+# Upstream deltas are merged into one SSE event per window or per this many characters
+STREAM_FLUSH_SECONDS = float(os.getenv("STREAM_FLUSH_MS", 50)) / 1000
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", 1024))
+
+FRAGMENT_CACHE_MAX_BYTES = int(os.getenv("FRAGMENT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Concurrent upstream calls, overall and per session; extra requests queue fairly
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 32))
+UPSTREAM_MAX_PER_SESSION = int(os.getenv("UPSTREAM_MAX_PER_SESSION", 2))
+# Retries for 429/5xx/connection errors before any output has streamed
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 3))
+
+# Finished responses stay replayable for reconnecting clients for this long
+STREAM_RESUME_TTL = float(os.getenv("STREAM_RESUME_TTL", 60))
+# Seconds to wait for a reconnect before cancelling an abandoned upstream call
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", 3))
+# Idle seconds between SSE keepalives, which also detect vanished clients
+STREAM_HEARTBEAT_SECONDS = 5
+# A client still this many seconds behind the reply is too slow to stream to:
+# "final" sends it only the finished answer, "disconnect" ends its stream so it
+# resumes later (0 disables)
+STREAM_CLIENT_MAX_LAG = float(os.getenv("STREAM_CLIENT_MAX_LAG", 10)) or None
+STREAM_SLOW_CLIENT_POLICY = os.getenv("STREAM_SLOW_CLIENT_POLICY", "final")
+if STREAM_SLOW_CLIENT_POLICY not in ("final", "disconnect"):
+    raise RuntimeError("STREAM_SLOW_CLIENT_POLICY must be 'final' or 'disconnect'")
+# "single-request" posts to /chat and streams the reply over the same response;
+# "two-request" posts to /send_message, then opens /stream-response
+STREAM_MODE = os.getenv("STREAM_MODE", "single-request")
+# Longest accepted user message; longer ones are rejected with 413
+MAX_MESSAGE_CHARS = int(os.getenv("MAX_MESSAGE_CHARS", 32000))
+
+# Worker processes sharing one port. With more than one (or with PROCS, which
+# runs copies on consecutive ports), conversations are shared through
+# CONVERSATION_DB and in-flight replies through STREAM_BROKER_DB, so any
+# worker can serve any request of a session and relay any reply.
+WORKERS = int(os.getenv("WORKERS", 1))
+SHARED_STATE = WORKERS > 1 or int(os.getenv("PROCS", 1)) > 1
+STREAM_BROKER_DB = os.getenv("STREAM_BROKER_DB", "streams.db")
+if SHARED_STATE and not CONVERSATION_DB:
+    raise RuntimeError("Running several workers needs CONVERSATION_DB to share conversations")
+
+# Model, and the OpenAI-compatible endpoints serving it. MODEL_ENDPOINTS is a
+# JSON list of {"base_url", "model", "api_key_env", "name"} objects; the default
+# is one endpoint at OPENAI_BASE_URL (or OpenAI) serving MODEL.
+MODEL = os.getenv("MODEL", "gpt-4o-mini")
+MODEL_ENDPOINTS = json.loads(os.getenv("MODEL_ENDPOINTS") or "[]") or [{"model": MODEL}]
+# Extra parameters sent with every completion, e.g. temperature
+MODEL_PARAMS = {}
+# Connection pool per endpoint, and connections opened at startup so the first
+# user request does not pay for connection and TLS setup
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_KEEPALIVE_CONNECTIONS", 20))
+UPSTREAM_KEEPALIVE_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS", 60))
+UPSTREAM_WARMUP_CONNECTIONS = int(os.getenv("UPSTREAM_WARMUP_CONNECTIONS", 2))
+# Send a second call when the first token is later than this percentile of
+# recent ones, for at most UPSTREAM_HEDGE_BUDGET of requests (unset disables)
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE") or 0) or None
+UPSTREAM_HEDGE_BUDGET = float(os.getenv("UPSTREAM_HEDGE_BUDGET", 0.1))
+
+SYSTEM_PROMPT = "You are a helpful business assistant. Be professional, friendly, and concise in your responses."
+GREETING = "Hello! I'm here to assist with your business needs. How can I help you today?"
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so you can continue it later without the transcript. "
+    "Extend the earlier summary if there is one. Keep names, figures, decisions, open questions "
+    "and the user's preferences; leave out pleasantries. Be brief."
+)
+
+# Per-session conversation histories, bounded in total memory
+conversations = ConversationStore(
+    greeting=GREETING,
+    max_bytes=MAX_CONVERSATION_BYTES,
+    idle_ttl=SESSION_IDLE_TTL,
+    max_messages=MAX_MESSAGES,
+    backend=SQLiteBackend(CONVERSATION_DB, shared=SHARED_STATE, max_ranked=SEARCH_MAX_RANKED) if CONVERSATION_DB else None,
+)
+
+# Replies in flight, published for the other workers to relay
+broker = SQLiteBroker(STREAM_BROKER_DB, ttl=STREAM_RESUME_TTL) if SHARED_STATE else None
+if broker is not None:
+    app.on_event("shutdown")(broker.close)
+
+# Completed responses for identical prompts, replayed without an upstream call
+response_cache = ResponseCache(
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+    path=RESPONSE_CACHE_PATH,
+    max_disk_bytes=RESPONSE_CACHE_DISK_MAX_BYTES,
+)
+
+# Rendered HTML of finished messages, for as long as the process runs
+fragment_cache = FragmentCache(max_bytes=FRAGMENT_CACHE_MAX_BYTES)
+
+# Request lifecycle metrics, exposed in Prometheus text format on /metrics.
+# The chunk loop only bumps local counters; metrics are recorded once per stream.
+metrics = Registry()
+BUILD_MESSAGES_SECONDS = metrics.histogram("chat_build_messages_seconds", "Time spent in build_api_messages")
+UPSTREAM_CONNECT_SECONDS = metrics.histogram("chat_upstream_connect_seconds", "Time to open the upstream completion stream")
+TTFT_SECONDS = metrics.histogram("chat_time_to_first_token_seconds", "Time from stream request to first chunk published")
+STREAM_SECONDS = metrics.histogram("chat_stream_duration_seconds", "Total duration of a response stream")
+TOKENS_PER_SECOND = metrics.histogram(
+    "chat_upstream_tokens_per_second", "Upstream deltas per second after the first",
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500, 1000)
+)
+UPSTREAM_TOKENS = metrics.counter("chat_upstream_tokens_total", "Content deltas received from upstream")
+SSE_BYTES = metrics.counter("chat_sse_bytes_total", "Bytes of SSE data sent to clients")
+SSE_EVENTS = metrics.counter("chat_sse_events_total", "SSE events sent to clients")
+OPEN_STREAMS = metrics.gauge("chat_open_streams", "SSE connections currently open")
+STREAM_ERRORS = metrics.counter("chat_stream_errors_total", "Failed response streams by error type", labels=("type",))
+SLOW_CLIENTS = metrics.counter("chat_slow_clients_total", "Streams too far behind their reply, by policy applied", labels=("policy",))
+STREAM_CANCELLED = metrics.counter("chat_stream_cancelled_total", "Responses cancelled after every client disconnected")
+UPSTREAM_RETRIES = metrics.counter("chat_upstream_retries_total", "Retried upstream calls by error type", labels=("type",))
+UPSTREAM_HEDGES = metrics.counter("chat_upstream_hedges_total", "Hedged upstream calls by which call won", labels=("winner",))
+SEARCH_SECONDS = metrics.histogram("chat_search_seconds", "Time to run a search query")
+COMPACTION_SECONDS = metrics.histogram("chat_compaction_seconds", "Time to summarize and store older turns")
+COMPACTION_ERRORS = metrics.counter("chat_compaction_errors_total", "Failed compactions by error type", labels=("type",))
+metrics.gauge("chat_upstream_active", "Upstream calls holding a scheduler slot", fn=lambda: scheduler.active)
+metrics.gauge("chat_upstream_waiting", "Requests queued for an upstream slot", fn=lambda: scheduler.waiting)
+metrics.gauge("chat_resident_sessions", "Conversations held in memory", fn=lambda: len(conversations))
+metrics.gauge("chat_resident_bytes", "Approximate memory held by resident conversations", fn=lambda: conversations.nbytes)
+
+# Upstream endpoints, routed by measured time to first token
+upstream = OpenAIBackend(
+    [
+        Endpoint(
+            spec.get("model", MODEL),
+            base_url=spec.get("base_url"),
+            api_key=os.getenv(spec.get("api_key_env", "OPENAI_API_KEY")),
+            name=spec.get("name"),
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive=UPSTREAM_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_SECONDS,
+        )
+        for spec in MODEL_ENDPOINTS
+    ],
+    hedge_percentile=UPSTREAM_HEDGE_PERCENTILE,
+    hedge_budget=UPSTREAM_HEDGE_BUDGET,
+    warmup_connections=UPSTREAM_WARMUP_CONNECTIONS,
+    on_connect=UPSTREAM_CONNECT_SECONDS.observe,
+    on_hedge=lambda winner: UPSTREAM_HEDGES.inc(winner=winner),
+)
+app.on_event("startup")(upstream.warmup)
+
+# Admission control, retries and single-flight in front of the provider
+scheduler = UpstreamScheduler(
+    max_concurrent=UPSTREAM_MAX_CONCURRENCY,
+    per_session=UPSTREAM_MAX_PER_SESSION,
+    max_retries=UPSTREAM_MAX_RETRIES,
+    on_retry=lambda e: UPSTREAM_RETRIES.inc(type=type(e).__name__),
+)
+
+# Per-message event buffers that reconnecting clients resume from
+response_streams = ResponseStreams(ttl=STREAM_RESUME_TTL, grace=STREAM_RESUME_GRACE,
+                                   max_lag=STREAM_CLIENT_MAX_LAG, slow_policy=STREAM_SLOW_CLIENT_POLICY)
+
+def session_id(session):
+    """Return the conversation id for this browser session, assigning one if needed"""
+    sid = session.get("sid")
+    if sid is None:
+        sid = session["sid"] = uuid.uuid4().hex
+    return sid
+
+def build_api_messages(conversation):
+    """Build the API messages array: the summary of older turns, then the
+    history after it, windowed to the token budget"""
+    history = list(conversation.messages)
+    summary = conversation.summary
+    summarized = summary[0] if summary else 0
+    conversation.context_start = window_start(
+        history, max(conversation.context_start, summarized + 1), CONTEXT_TOKEN_BUDGET, CONTEXT_EVICT_BLOCK
+    )
+
+    # System prompt, pinned greeting, summary, then the windowed history (which
+    # ends with the current user message). Only the tail changes between turns.
+    api_messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for msg in history:
+        if msg.seq == 0 or msg.seq >= conversation.context_start:
+            api_messages.append({
+                "role": "assistant" if msg.sender == "ai" else "user",
+                "content": msg.message
+            })
+        if msg.seq == 0 and summary:
+            api_messages.append({"role": "system", "content": "Summary of the earlier conversation:\n" + summary[1]})
+
+    return api_messages
+
+async def summarize_turns(previous, messages):
+    """Summary of `messages`, extending the earlier summary `previous`"""
+    transcript = "\n\n".join(
+        f"{'Assistant' if msg.sender == 'ai' else 'User'}: {msg.message}" for msg in messages
+    )
+    if previous:
+        transcript = f"Earlier summary:\n{previous}\n\nConversation since:\n{transcript}"
+    return await upstream.complete(
+        [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+        max_tokens=COMPACTION_SUMMARY_TOKENS,
+        **MODEL_PARAMS
+    )
+
+# Summarizes the oldest turns of long conversations after replies finish
+compactor = Compactor(
+    conversations,
+    summarize_turns,
+    threshold=COMPACTION_THRESHOLD,
+    keep=COMPACTION_KEEP_TOKENS,
+    delay=COMPACTION_DELAY,
+    on_done=COMPACTION_SECONDS.observe,
+    on_error=lambda e: COMPACTION_ERRORS.inc(type=type(e).__name__),
+)
+# Shutdown handlers run in order: compactions stop before the upstream and store they use close
+app.on_event("shutdown")(compactor.close)
+app.on_event("shutdown")(upstream.close)
+app.on_event("shutdown")(conversations.close)
+
+def render_md(md, css='', **kwargs):
+    """Simple markdown renderer using zero-md"""
+    if css:
+        css_template = Template(Style(css), data_append=True)
+        return Zero_md(css_template, Script(md, type="text/markdown"), **kwargs)
+    else:
+        return Zero_md(Script(md, type="text/markdown"), **kwargs)
+
+def render_block(source):
+    """HTML of one finished markdown block, cached alongside message fragments"""
+    return fragment_cache.render(content_hash("md", source), lambda: rendering.render_markdown(source))
+
+def markdown_view(md, message_id):
+    """A finished answer, rendered on the server or left to zero-md"""
+    if SERVER_MARKDOWN:
+        # Split exactly as while streaming, so the blocks rendered then are reused
+        html = "".join(render_block(block) for block in rendering.split_blocks(md))
+        return Div(NotStr(html), id=message_id, cls="markdown-body")
+    return render_md(md, id=message_id)
+
+def markdown_placeholder(message_id):
+    """Where a streamed answer is rendered; server-rendered blocks are appended
+    to the first child and the partial block replaces the second"""
+    if SERVER_MARKDOWN:
+        return Div(Div(), Div(), id=message_id, cls="markdown-body", data_render="server")
+    return render_md("", id=message_id)
+
+
+async def get_ai_response_streaming_async(conversation):
     """Async generator for OpenAI streaming"""
     try:
         # Use helper function to build API messages
-        api_messages = build_api_messages(user_message, conversation_history)
+        started = time.perf_counter()
+        api_messages = build_api_messages(conversation)
+        BUILD_MESSAGES_SECONDS.observe(time.perf_counter() - started)
         
-        # Use async streaming response from OpenAI
-        stream = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=api_messages,
-            stream=True
-        )
+        # Replay a cached answer for an identical prompt
+        key = cache_key(api_messages, {**MODEL_PARAMS, "models": upstream.models})
+        cached = await response_cache.get(key)
+        if cached is not None:
+            for chunk in replay_chunks(cached):
+                yield chunk
+            return
         
-        async for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        # Streamed from the endpoint answering fastest lately
+        open_upstream = lambda: upstream.stream(api_messages, **MODEL_PARAMS)
+        
+        # Queued behind the concurrency limits; identical in-flight prompts share one call
+        parts = []
+        first_token = None
+        async for chunk in scheduler.stream(key, conversation.session_id, open_upstream):
+            if first_token is None:
+                first_token = time.perf_counter()
+            parts.append(chunk)
+            yield chunk
+        
+        if len(parts) > 1:
+            TOKENS_PER_SECOND.observe((len(parts) - 1) / max(time.perf_counter() - first_token, 1e-6))
+        UPSTREAM_TOKENS.inc(len(parts))
+        
+        # Only cache responses that streamed to completion
+        await response_cache.put(key, "".join(parts))
                 
     except OpenAIError as e:
         print(f"OpenAI API error: {e}")
+        STREAM_ERRORS.inc(type=type(e).__name__)
         yield f"OpenAI service error: {str(e)}"
     except Exception as e:
         print(f"Unexpected error: {e}")
+        STREAM_ERRORS.inc(type=type(e).__name__)
         yield f"Unexpected error occurred: {str(e)}"
 
 
@@ -154,8 +488,8 @@ def send_icon():
         Polygon(points="22 2 15 22 11 13 2 9 22 2", cls="stroke-current")
     )
 
-def user_message(message):
-    return Div(cls="chat-message flex items-start gap-4 justify-end")(
+def user_message(message, anchor=None):
+    return Div(cls="chat-message flex items-start gap-4 justify-end", id=anchor)(
         Div(cls="bg-blue-600 rounded-lg p-4 max-w-lg order-1")(
             P("You", cls="font-semibold text-white mb-1"),
             P(message)
@@ -165,38 +499,108 @@ def user_message(message):
         )
     )
 
-def ai_message(message, message_id=None, use_markdown=True):
-    if message_id is None:
-        message_id = f"ai-message-{len(messages)}"
-    
-    return Div(cls="chat-message flex items-start gap-4")(
+def ai_message(message, message_id, use_markdown=True, anchor=None):
+    return Div(cls="chat-message flex items-start gap-4", id=anchor)(
         Div(cls="flex-shrink-0")(
             Img(cls="w-10 h-10 rounded-full", src="https://placehold.co/40x40/7E57C2/FFFFFF?text=AI", alt="AI Avatar")
         ),
         Div(cls="bg-gray-800 rounded-lg p-4 max-w-lg")(
             P("AI Assistant", cls="font-semibold text-gray-300 mb-1"),
             Div(cls="text-gray-300")(
-                render_md(message, dark_md_css, id=message_id) if use_markdown 
+                markdown_view(message, message_id) if use_markdown 
                 else P(message, cls="text-gray-300")
             )
         )
     )
 
-def chat_messages():
+def message_component(msg):
+    # Anchored so search results can link to the message
+    anchor = f"message-{msg.seq}"
+    if msg.sender != "ai":
+        return user_message(msg.message, anchor)
+    return ai_message(msg.message, f"ai-message-{msg.seq}", use_markdown=msg.seq != 0, anchor=anchor)
+
+def message_list(page):
+    # Finished messages never change, so their HTML is rendered once and reused.
+    # The fragments are joined up front; nesting thousands of them is slow to serialize.
+    return NotStr("".join(
+        fragment_cache.render(content_hash(msg.seq, msg.sender, msg.message), lambda msg=msg: message_component(msg))
+        for msg in page
+    ))
+
+def history_loader(cursor, direction="before"):
+    """Placeholder that swaps itself for the next older (or, `after` a cursor, newer) page once scrolled into view"""
+    # `intersect` rather than `revealed`, which does not fire inside an overflow container
+    return Div(
+        hx_get=f"/history?{direction}={cursor}",
+        hx_trigger="intersect once",
+        hx_swap="outerHTML",
+        cls="h-px"
+    )
+
+def history_page(page, cursor, newer=None):
+    return (([history_loader(cursor)] if cursor is not None else []) + [message_list(page)]
+            + ([history_loader(newer, "after")] if newer is not None else []))
+
+def chat_messages(page, cursor, newer=None):
     return Main(id="chat-messages", cls="flex-1 p-4 md:p-6 space-y-6 overflow-y-auto")(
-        *[ai_message(msg["message"], use_markdown=False) if msg["sender"] == "ai" and msg == messages[0] 
-          else ai_message(msg["message"]) if msg["sender"] == "ai" 
-          else user_message(msg["message"]) for msg in messages]
+        *history_page(page, cursor, newer)
+    )
+
+def search_box():
+    """Search field for the conversation, with results listed under it as you type"""
+    return Div(cls="px-4 md:px-6 mb-4")(
+        Input(
+            id="search-input",
+            type="search",
+            name="q",
+            placeholder="Search this conversation...",
+            autocomplete="off",
+            hx_get="/search",
+            hx_trigger="input changed delay:300ms, search",
+            hx_target="#search-results",
+            cls="w-full bg-gray-800 text-gray-200 rounded-lg px-4 py-2 focus:outline-none focus:ring-2 focus:ring-blue-500"
+        ),
+        Div(id="search-results", cls="max-h-80 overflow-y-auto mt-2 space-y-1")
+    )
+
+def search_hit(seq, sender, snippet):
+    return A(href=f"/?at={seq}#message-{seq}", cls="block rounded-lg px-3 py-2 hover:bg-gray-800")(
+        Span("AI Assistant" if sender == "ai" else "You", cls="text-xs font-semibold text-gray-400"),
+        P(NotStr(snippet_html(snippet)), cls="text-sm text-gray-300")
     )
 
+def search_results(query, hits, page, more):
+    """One page of results; the "more" button swaps itself for the next page"""
+    items = [search_hit(*hit) for hit in hits]
+    if more:
+        items.append(Button(
+            "More results",
+            hx_get=f"/search?{urlencode({'q': query, 'page': page + 1})}",
+            hx_target="this",
+            hx_swap="outerHTML",
+            cls="w-full text-sm text-blue-400 hover:text-blue-300 py-2"
+        ))
+    if page == 1 and not hits:
+        items.append(P("No messages match.", cls="text-sm text-gray-400 px-3 py-2"))
+    return tuple(items)
+
+# htmx handles the form when sending and streaming are separate requests
+TWO_REQUEST_ATTRS = dict(
+    hx_post="/send_message",
+    hx_target="#chat-messages",
+    hx_swap="beforeend scroll:bottom",
+    hx_indicator="#chat-input-container .htmx-indicator",
+)
+
 def chat_input():
     return Footer(id="chat-input-container", cls="bg-gray-800/50 backdrop-blur-sm border-t border-gray-700 mt-6 p-4 sticky bottom-0")(
         Form(
             id="chat-form",
-            hx_post="/send_message",
-            hx_target="#chat-messages",
-            hx_swap="beforeend scroll:bottom",
-            hx_indicator="#chat-input-container .htmx-indicator",
+            action="/chat",
+            method="post",
+            data_stream_mode=STREAM_MODE,
+            **(TWO_REQUEST_ATTRS if STREAM_MODE == "two-request" else {}),
             cls="flex items-center space-x-4"
         )(
             Textarea(
@@ -220,269 +624,190 @@ def chat_input():
     )
 
 @rt('/')
-def index():
+def index(session, at: int = None):
+    # Only the latest page is rendered, or for a search result the page around
+    # message `at`; the pages next to it load on demand from /history
+    sid = session_id(session)
+    if at is None:
+        page, cursor = conversations.page(sid, limit=HISTORY_PAGE_SIZE)
+        newer = None
+    else:
+        page, cursor, newer = conversations.around(sid, at, HISTORY_PAGE_SIZE)
     return Div(cls="bg-gray-900 text-white font-sans antialiased")(
             Div(id="chat-container", cls="flex flex-col h-screen max-w-4xl mx-auto py-6")(
-                chat_messages(),
+                search_box(),
+                chat_messages(page, cursor, newer),
                 chat_input()
+            )
+        )
+
+@rt('/history')
+def history(session, before: int = None, after: int = None):
+    if after is not None:
+        page, newer = conversations.newer(session_id(session), after, HISTORY_PAGE_SIZE)
+        return tuple(history_page(page, None, newer))
+    page, cursor = conversations.page(session_id(session), before, HISTORY_PAGE_SIZE)
+    return tuple(history_page(page, cursor))
+
+@rt('/search')
+def search(session, q: str = "", page: int = 1):
+    """Ranked full-text search of this session's conversation, as an htmx fragment"""
+    if not q.strip():
+        return ""
+    if not conversations.backend.searchable:
+        return P("Search needs CONVERSATION_DB.", cls="text-sm text-gray-400 px-3 py-2")
+    started = time.perf_counter()
+    page = max(page, 1)
+    hits = conversations.search(session_id(session), q, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE)
+    SEARCH_SECONDS.observe(time.perf_counter() - started)
+    return search_results(q, hits[:SEARCH_PAGE_SIZE], page, len(hits) > SEARCH_PAGE_SIZE)
+
+def ai_placeholder(message_id, stream=False):
+    """Reply bubble that the client fills in as the response streams.
+
+    With `stream`, the client opens /stream-response for it after the swap.
+    """
+    return Div(cls="chat-message flex items-start gap-4", id=f"container-{message_id}",
+               data_stream=message_id if stream else None)(
+        Div(cls="flex-shrink-0")(
+            Img(cls="w-10 h-10 rounded-full", src="https://placehold.co/40x40/7E57C2/FFFFFF?text=AI", alt="AI Avatar")
+        ),
+        Div(cls="bg-gray-800 rounded-lg p-4 max-w-lg")(
+            P("AI Assistant", cls="font-semibold text-gray-300 mb-1"),
+            Div(cls="flex items-center", id=f"typing-{message_id}")(
+                Span("AI is thinking", cls="font-semibold text-gray-300 mr-3"),
+                Div(cls="flex items-center space-x-1")(
+                    Div(cls="w-1.5 h-1.5 bg-blue-400 rounded-full animate-pulse"),
+                    Div(cls="w-1.5 h-1.5 bg-blue-400 rounded-full animate-pulse", style="animation-delay: 0.2s;"),
+                    Div(cls="w-1.5 h-1.5 bg-blue-400 rounded-full animate-pulse", style="animation-delay: 0.4s;")
+                )
             ),
-            Script("""
-                // Auto-scroll to bottom on page load
-                window.onload = () => {
-                    const chatMessages = document.getElementById('chat-messages');
-                    chatMessages.scrollTop = chatMessages.scrollHeight;
-                    
-                    // Initialize KaTeX for existing content
-                    const existingZeroMd = document.querySelectorAll('zero-md');
-                    existingZeroMd.forEach(element => {
-                        setTimeout(() => renderKaTeX(element), 200);
-                    });
-                };
-                
-                // Function to highlight code blocks in zero-md content
-                function highlightCodeBlocks(container) {
-                    if (typeof hljs !== 'undefined') {
-                        const codeBlocks = container.querySelectorAll('pre code');
-                        codeBlocks.forEach(block => {
-                            hljs.highlightElement(block);
-                        });
-                    }
-                }
-                
-                // Function to render KaTeX math expressions in zero-md content
-                function renderKaTeX(container) {
-                    function doRender() {
-                        if (typeof renderMathInElement !== 'undefined') {
-                            const target = container.shadowRoot || container;
-                            try {
-                                renderMathInElement(target, {
-                                    delimiters: [
-                                        {left: '$$', right: '$$', display: true},
-                                        {left: '$', right: '$', display: false},
-                                        {left: '\\(', right: '\\)', display: false},
-                                        {left: '\\[', right: '\\]', display: true}
-                                    ],
-                                    throwOnError: false
-                                });
-                            } catch (e) {
-                                console.error('KaTeX rendering error:', e);
-                            }
-                        }
-                    }
-                    
-                    // Use requestAnimationFrame for better timing
-                    if (window.katexLoaded || typeof renderMathInElement !== 'undefined') {
-                        requestAnimationFrame(() => {
-                            requestAnimationFrame(doRender); // Double RAF for stability
-                        });
-                    } else {
-                        // Fallback with timeout
-                        setTimeout(() => renderKaTeX(container), 100);
-                    }
-                }
-                
-                // Observer to highlight code and render KaTeX when zero-md content loads
-                const observer = new MutationObserver((mutations) => {
-                    mutations.forEach((mutation) => {
-                        mutation.addedNodes.forEach((node) => {
-                            if (node.nodeType === Node.ELEMENT_NODE) {
-                                // Check if it's a zero-md element or contains one
-                                const zeroMdElements = node.tagName === 'ZERO-MD' ? [node] : node.querySelectorAll ? node.querySelectorAll('zero-md') : [];
-                                zeroMdElements.forEach((zeroMd) => {
-                                    // Use requestAnimationFrame instead of setTimeout
-                                    requestAnimationFrame(() => {
-                                        highlightCodeBlocks(zeroMd);
-                                        renderKaTeX(zeroMd);
-                                    });
-                                });
-                            }
-                        });
-                    });
-                });
-                // Only observe the chat messages container instead of entire document
-                const chatContainer = document.getElementById('chat-messages');
-                if (chatContainer) {
-                    observer.observe(chatContainer, { childList: true, subtree: true });
-                }
-                
-                // Auto-resize textarea
-                document.addEventListener('input', (e) => {
-                    if (e.target.tagName === 'TEXTAREA') {
-                        e.target.style.height = 'auto';
-                        e.target.style.height = (e.target.scrollHeight) + 'px';
-                    }
-                });
-                
-                // Handle Enter key (submit) vs Shift+Enter (new line)
-                document.addEventListener('keydown', (e) => {
-                    if (e.target.tagName === 'TEXTAREA' && e.key === 'Enter' && !e.shiftKey) {
-                        e.preventDefault();
-                        const form = e.target.closest('form');
-                        // Only submit if not processing
-                        if (!form.getAttribute('data-processing')) {
-                            form.requestSubmit();
-                        }
-                    }
-                });
-                
-                // Handle form submission - disable button and set processing flag
-                document.addEventListener('submit', (e) => {
-                    if (e.target.id === 'chat-form') {
-                        if (e.target.getAttribute('data-processing')) {
-                            e.preventDefault();
-                        } else {
-                            // Disable button and set processing flag
-                            const submitBtn = document.getElementById('submit-btn');
-                            submitBtn.disabled = true;
-                            e.target.setAttribute('data-processing', 'true');
-                        }
-                    }
-                });
-                
-                // Clear textarea on successful form submit
-                document.addEventListener('htmx:afterRequest', (e) => {
-                    if (e.target.id === 'chat-form' && e.detail.successful) {
-                        const textarea = e.target.querySelector('textarea');
-                        textarea.value = '';
-                        textarea.style.height = 'auto';
-                    }
-                });
-            """)
+            Div(cls="text-gray-300", style="display: none;", id=f"content-{message_id}")(
+                markdown_placeholder(message_id)
+            )
         )
+    )
+
+def message_too_long(message):
+    if len(message) > MAX_MESSAGE_CHARS:
+        return Response(f"Message is longer than {MAX_MESSAGE_CHARS} characters", status_code=413)
 
 @rt('/send_message')
-def post(message: str):
+def post(message: str, session):
+    if (error := message_too_long(message)) is not None:
+        return error
     # Add user message
-    messages.append({"sender": "user", "message": message})
-    manage_conversation_memory()
-    message_id = f"ai-message-{len(messages)}"
+    record = conversations.append(session_id(session), "user", message)
+    message_id = f"ai-message-{record.seq + 1}"
     
-    return (
-        user_message(message),
-        Div(cls="chat-message flex items-start gap-4", id=f"container-{message_id}")(
-            Div(cls="flex-shrink-0")(
-                Img(cls="w-10 h-10 rounded-full", src="https://placehold.co/40x40/7E57C2/FFFFFF?text=AI", alt="AI Avatar")
-            ),
-            Div(cls="bg-gray-800 rounded-lg p-4 max-w-lg")(
-                P("AI Assistant", cls="font-semibold text-gray-300 mb-1"),
-                Div(cls="flex items-center", id=f"typing-{message_id}")(
-                    Span("AI is thinking", cls="font-semibold text-gray-300 mr-3"),
-                    Div(cls="flex items-center space-x-1")(
-                        Div(cls="w-1.5 h-1.5 bg-blue-400 rounded-full animate-pulse"),
-                        Div(cls="w-1.5 h-1.5 bg-blue-400 rounded-full animate-pulse", style="animation-delay: 0.2s;"),
-                        Div(cls="w-1.5 h-1.5 bg-blue-400 rounded-full animate-pulse", style="animation-delay: 0.4s;")
-                    )
-                ),
-                Div(cls="text-gray-300", style="display: none;", id=f"content-{message_id}")(
-                    render_md("", dark_md_css, id=message_id)
-                )
-            )
-        ),
-        Script(f"""
-            (function() {{
-                const messageId = {json.dumps(message_id)};
-                const userMessage = {json.dumps(message)};
-                
-                const eventSource = new EventSource('/stream-response?message_id=' + messageId + '&user_message=' + encodeURIComponent(userMessage));
-                let fullContent = '';
-                
-                eventSource.onmessage = function(event) {{
-                    if (event.data === '[DONE]') {{
-                        eventSource.close();
-                        // Re-enable form
-                        const form = document.getElementById('chat-form');
-                        const submitBtn = document.getElementById('submit-btn');
-                        form.removeAttribute('data-processing');
-                        submitBtn.disabled = false;
-                        return;
-                    }}
-                    
-                    try {{
-                        const data = JSON.parse(event.data);
-                        
-                        if (data.type === 'start') {{
-                            // Hide typing indicator and show content on start
-                            const typingDiv = document.getElementById('typing-{message_id}');
-                            const contentDiv = document.getElementById('content-{message_id}');
-                            if (typingDiv) typingDiv.style.display = 'none';
-                            if (contentDiv) contentDiv.style.display = 'block';
-                        }} else if (data.type === 'chunk') {{
-                            fullContent += data.content;
-                            const zeroMdElement = document.getElementById(messageId);
-                            if (zeroMdElement) {{
-                                const scriptElement = zeroMdElement.querySelector('script[type="text/markdown"]');
-                                if (scriptElement) {{
-                                    scriptElement.textContent = fullContent;
-                                }}
-                                // Don't render KaTeX during streaming to avoid incomplete expressions
-                            }}
-                        }} else if (data.type === 'complete') {{
-                            // Final update and trigger syntax highlighting
-                            const zeroMdElement = document.getElementById(messageId);
-                            if (zeroMdElement) {{
-                                const scriptElement = zeroMdElement.querySelector('script[type="text/markdown"]');
-                                if (scriptElement) {{
-                                    scriptElement.textContent = data.content;
-                                    // Use requestAnimationFrame for better timing
-                                    requestAnimationFrame(() => {{
-                                        if (typeof hljs !== 'undefined') {{
-                                            const codeBlocks = zeroMdElement.querySelectorAll('pre code');
-                                            codeBlocks.forEach(block => {{
-                                                hljs.highlightElement(block);
-                                            }});
-                                        }}
-                                        renderKaTeX(zeroMdElement);
-                                    }});
-                                }}
-                            }}
-                        }} else if (data.type === 'error') {{
-                            console.error('Streaming error:', data.content);
-                            const contentDiv = document.getElementById('content-{message_id}');
-                            if (contentDiv) {{
-                                contentDiv.innerHTML = '<div class="text-red-500 p-4 bg-red-50 rounded border-l-4 border-red-400">❌ ' + data.content + '</div>';
-                            }}
-                        }}
-                    }} catch (e) {{
-                        console.error('Error parsing SSE data:', e, event.data);
-                    }}
-                }};
-                
-                eventSource.onerror = function(error) {{
-                    console.error('EventSource failed:', error);
-                    eventSource.close();
-                    // Re-enable form on error
-                    const form = document.getElementById('chat-form');
-                    const submitBtn = document.getElementById('submit-btn');
-                    form.removeAttribute('data-processing');
-                    submitBtn.disabled = false;
-                }};
-            }})();
-        """)
-    )
+    # The client streams the reply from /stream-response once this is swapped in
+    return user_message(message), ai_placeholder(message_id, stream=True)
 
-@rt('/stream-response')
-async def stream_response(message_id: str, user_message: str):
+async def produce_response(buffer, sid, started):
+    """Generate one reply into `buffer`, independently of any client connection"""
+    parts = []
+    blocks = rendering.BlockStream(render_block) if SERVER_MARKDOWN else None
+    if blocks is not None:
+        buffer.snapshot = lambda: {"html": "".join(blocks.html), "tail": blocks.tail()}
+    try:
+        buffer.publish({"type": "start", "content": "", "queue_position": scheduler.queue_position(sid)})
+        
+        # Stream coalesced deltas; the client appends each one to what it has.
+        # With server rendering, events also carry the HTML of newly finished
+        # blocks and of the partial block after them.
+        chunks = get_ai_response_streaming_async(await asyncio.to_thread(conversations.get, sid))
+        async for chunk in coalesce(chunks, STREAM_FLUSH_SECONDS, STREAM_FLUSH_CHARS):
+            if not parts:
+                TTFT_SECONDS.observe(time.perf_counter() - started)
+            parts.append(chunk)
+            event = {"type": "chunk", "content": chunk}
+            if blocks is not None:
+                event["blocks"] = blocks.feed(chunk)
+                event["tail"] = blocks.tail()
+            buffer.publish(event)
+        
+        # Add complete response to messages
+        await asyncio.to_thread(conversations.append, sid, "ai", "".join(parts))
+        event = {"type": "complete"}
+        if blocks is not None:
+            event["blocks"] = blocks.close()
+            event["tail"] = ""
+            if blocks.replaced:
+                # The answer's link definitions change blocks already sent
+                event["replace"] = True
+        buffer.publish(event)
+        # Summarizes older turns later, in the background, if the history has grown long
+        compactor.schedule(sid)
+        
+    except asyncio.CancelledError:
+        # Every client went away; stop generating tokens nobody will read
+        STREAM_CANCELLED.inc()
+        raise
+    except Exception as e:
+        STREAM_ERRORS.inc(type=type(e).__name__)
+        error_msg = f"Error: {str(e)}"
+        await asyncio.to_thread(conversations.append, sid, "ai", error_msg)
+        buffer.publish({"type": "error", "content": error_msg})
+    finally:
+        buffer.finish()
+        STREAM_SECONDS.observe(time.perf_counter() - started)
+
+async def start_response(sid, message_id, started):
+    """Start generating the reply to the latest message, buffered for resuming clients.
+
+    Returns the buffer of a reply this worker already started, or None when
+    another worker claimed it first; it is relayed from the broker instead,
+    so it is generated and stored only once.
+    """
+    key = f"{sid}:{message_id}"
+    # Checked with no await before create(), so concurrent requests share one producer
+    buffer = response_streams.get(key)
+    if buffer is not None:
+        return buffer
+    if broker is not None and not await asyncio.to_thread(broker.claim, key):
+        return None
+    buffer = response_streams.create(key)
+    buffer.on_slow = lambda policy: SLOW_CLIENTS.inc(policy=policy)
+    if broker is not None:
+        buffer.on_event = lambda event_id, event, done: broker.publish(key, event_id, event, done)
+        buffer.watched = lambda: broker.watched(key)
+    buffer.task = asyncio.create_task(produce_response(buffer, sid, started))
+    return buffer
+
+def subscribe(sid, message_id, buffer, last_id):
+    """Events of a reply after `last_id`, from `start_response`'s buffer or,
+    when another worker claimed the reply, from the broker"""
+    if buffer is None:
+        return broker.subscribe(f"{sid}:{message_id}", last_id, STREAM_HEARTBEAT_SECONDS)
+    return buffer.subscribe(last_id, STREAM_HEARTBEAT_SECONDS)
+
+def sse_response(source, first=None):
+    """Stream the SSE events of `source`, optionally preceded by the event `first`.
+
+    `source` is a subscription to a reply, or None if it has expired.
+    """
     async def generate():
+        sent_bytes = 0
+        events = 0
+        OPEN_STREAMS.inc()
         try:
-            yield "data: " + json.dumps({"type": "start", "content": ""}) + "\n\n"
-            
-            full_response = ""
-            # Stream chunks as they arrive from OpenAI
-            async for chunk in get_ai_response_streaming_async(user_message, messages):
-                full_response += chunk
-                yield "data: " + json.dumps({"type": "chunk", "content": chunk}) + "\n\n"
-            
-            # Add complete response to messages
-            messages.append({"sender": "ai", "message": full_response})
-            manage_conversation_memory()
-            yield "data: " + json.dumps({"type": "complete", "content": full_response}) + "\n\n"
-            yield "data: [DONE]\n\n"
-            
-        except Exception as e:
-            error_msg = f"Error: {str(e)}"
-            messages.append({"sender": "ai", "message": error_msg})
-            yield "data: " + json.dumps({"type": "error", "content": error_msg}) + "\n\n"
-            yield "data: [DONE]\n\n"
+            if first is not None:
+                sent_bytes += len(first)
+                events += 1
+                yield first
+            if source is None:
+                # Resuming a response that has already expired; don't generate a second one
+                yield sse_event({"type": "error", "content": "This response is no longer available."})
+                yield SSE_DONE
+                return
+            async for event in source:
+                sent_bytes += len(event)
+                events += 1
+                yield event
+        finally:
+            OPEN_STREAMS.dec()
+            SSE_BYTES.inc(sent_bytes)
+            SSE_EVENTS.inc(events)
     
     return StreamingResponse(
         generate(), 
@@ -494,4 +819,73 @@ async def stream_response(message_id: str, user_message: str):
         }
     )
 
-serve()
\ No newline at end of file
+@rt('/chat', methods=['post'])
+async def chat(message: str, session):
+    """Send a message and stream the reply over the same response.
+
+    The first event carries the HTML for the user bubble and the reply
+    placeholder; the reply's events follow, numbered as on /stream-response
+    so a dropped client can resume there.
+    """
+    started = time.perf_counter()
+    if (error := message_too_long(message)) is not None:
+        return error
+    sid = session_id(session)
+    # Conversation storage may wait on other workers' writes; keep it off the event loop
+    record = await asyncio.to_thread(conversations.append, sid, "user", message)
+    message_id = f"ai-message-{record.seq + 1}"
+    
+    buffer = await start_response(sid, message_id, started)
+    bubble = to_xml((user_message(message), ai_placeholder(message_id)), indent=False)
+    return sse_response(subscribe(sid, message_id, buffer, 0),
+                        first=sse_event({"type": "bubble", "message_id": message_id, "html": bubble}))
+
+@rt('/stream-response')
+async def stream_response(message_id: str, session, request, last_event_id: str = ""):
+    started = time.perf_counter()
+    sid = session_id(session)
+    
+    # A reconnecting client resumes from the last event id it saw, without a new
+    # upstream call. EventSource sends it as a header; a fetch stream that dropped
+    # passes it in the query string.
+    key = f"{sid}:{message_id}"
+    last_event_id = request.headers.get("last-event-id", last_event_id)
+    last_id = int(last_event_id) if last_event_id.isdigit() else 0
+    buffer = response_streams.get(key)
+    if buffer is None and broker is not None and await asyncio.to_thread(broker.exists, key):
+        # Generated by another worker; relay it from the broker
+        return sse_response(broker.subscribe(key, last_id, STREAM_HEARTBEAT_SECONDS))
+    if buffer is None and last_id == 0:
+        # Only the reply the latest message is waiting for is generated; an
+        # unknown or expired id must not start another upstream call
+        pending = await asyncio.to_thread(conversations.awaiting_reply, sid)
+        if pending is not None and message_id == f"ai-message-{pending}":
+            return sse_response(subscribe(sid, message_id, await start_response(sid, message_id, started), 0))
+    return sse_response(buffer.subscribe(last_id, STREAM_HEARTBEAT_SECONDS) if buffer is not None else None)
+
+@rt('/stats')
+def stats():
+    return {
+        **conversations.stats(),
+        "response_cache": response_cache.stats(),
+        "fragment_cache": fragment_cache.stats(),
+        "upstream": scheduler.stats(),
+        "endpoints": upstream.stats(),
+        "compaction": compactor.stats(),
+    }
+
+@rt('/code-theme')
+def code_theme():
+    # Versioned by content in the page, so it can be cached for good
+    return Response(CODE_CSS, media_type="text/css",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+@rt('/metrics')
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+if WORKERS > 1:
+    # Live reload supervises a single process
+    serve(workers=WORKERS, reload=False)
+else:
+    serve()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import math
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[n] for n in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonic count, optionally split by labels"""
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if not values and not self.label_names:
+            values = {(): 0}
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in values.items()]
+
+
+class Gauge(Metric):
+    """Point-in-time value, either set directly or read from `fn` at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        super().__init__(name, help)
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def _samples(self):
+        value = self.fn() if self.fn else self.value
+        return [f"{self.name} {_number(value)}"]
+
+
+class Histogram(Metric):
+    """Cumulative bucketed distribution, as Prometheus expects"""
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts plus +Inf, then the running sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def _samples(self):
+        with self._lock:
+            series = {k: (list(counts), total) for k, (counts, total) in self._series.items()}
+        if not series and not self.label_names:
+            series = {(): ([0] * (len(self.buckets) + 1), 0.0)}
+        lines = []
+        for key, (counts, total) in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = _labels(self.label_names, key, [f'le="{_number(bound)}"'])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, fn=None):
+        return self.register(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def render(self):
+        return "\n".join(m.render() for m in self._metrics) + "\n"
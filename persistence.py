@@ -0,0 +1,394 @@
+import time
+import queue
+import sqlite3
+import threading
+
+from search import MATCH_END, MATCH_START, match_expression, score_expression, term_weights
+
+
+class SeqTaken(Exception):
+    """Another process already stored a message at this seq"""
+
+
+def _token_count(sizes):
+    """Tokens in the first column of an FTS5 row, from its docsize blob of varints"""
+    count = 0
+    for byte in sizes:
+        count = count << 7 | byte & 0x7F
+        if byte < 0x80:
+            break
+    return count
+
+
+class ConversationBackend:
+    """Durable storage under the in-memory conversation store.
+
+    Backends are append-only: `append` records a message and must return
+    without blocking, `load_recent` returns the latest messages of one
+    conversation (optionally only those with seq below `before`) as
+    (seq, sender, message) tuples in ascending seq order. Reads include
+    appends that have not reached storage yet, so a conversation evicted
+    from memory reloads with every seq it has used.
+
+    A `shared` backend is written by several processes at once. Its
+    `append` commits before returning and raises SeqTaken if the seq is
+    already used, and `latest_seq` lets a process notice that its copy of
+    a conversation is out of date.
+
+    A conversation may also have a summary of its older messages, stored
+    with the last seq it covers; `save_summary` only ever moves it forward.
+
+    A `searchable` backend keeps a full-text index of every message, and
+    `search` returns the best matches in one conversation of terms from
+    `search.parse_query`, as (seq, sender, snippet) tuples.
+    """
+
+    shared = False
+    searchable = False
+
+    def append(self, session_id, seq, sender, message):
+        pass
+
+    def load_recent(self, session_id, limit, before=None):
+        return []
+
+    def latest_seq(self, session_id):
+        """Highest stored seq of a conversation, or None if it has none"""
+        return None
+
+    def save_summary(self, session_id, upto_seq, summary):
+        pass
+
+    def search(self, session_id, terms, limit=20, offset=0):
+        return []
+
+    def load_summary(self, session_id):
+        """(upto_seq, summary) of a conversation, or None"""
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(ConversationBackend):
+    """SQLite backend in WAL mode with batched writes on a background thread.
+
+    Appends go onto a queue and return immediately. A single writer thread
+    drains the queue and commits everything waiting (up to `batch_size`
+    rows) in one transaction, so the event loop never waits on disk. Reads
+    use a separate connection, which WAL lets run alongside the writer.
+
+    Queued rows stay visible to `load_recent` and `latest_seq` until they
+    are committed. Seqs are never overwritten: a row whose seq is already
+    stored is reported and dropped.
+
+    With `shared`, several worker processes use the same file. Each append
+    is then committed right away, so the next request for the conversation
+    sees it whichever worker serves it.
+
+    Messages are indexed for search in the same transaction that stores
+    them, into an FTS5 table in the same file. Its rowids are
+    the conversation's number shifted left 32 bits plus the seq, so one
+    conversation's messages are a rowid range that a query seeks to
+    rather than filters for: search time grows with the conversation, not
+    with the whole store. Only the newest `max_ranked` matches of a query
+    are ranked, which bounds its cost however common its words are. The
+    index lives on disk; memory use is SQLite's page cache.
+    """
+
+    def __init__(self, path, batch_size=500, batch_delay=0.05, shared=False, max_ranked=200):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.shared = shared
+        self.max_ranked = max_ranked
+        self._queue = queue.Queue()
+        self._read_lock = threading.Lock()
+        # session_id -> {seq: (seq, sender, message)} queued but not yet committed
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+        db = self._connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, sender TEXT NOT NULL, "
+            "message TEXT NOT NULL, created REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0), "
+            "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "session_id TEXT PRIMARY KEY, upto_seq INTEGER NOT NULL, summary TEXT NOT NULL)"
+        )
+        db.commit()
+        self.searchable = self._create_index(db)
+        db.create_function("token_count", 1, _token_count, deterministic=True)
+        self._reader = db
+
+        self._writer = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _create_index(self, db):
+        """Create the search index, indexing any existing messages, unless it exists"""
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_index'").fetchone():
+                db.rollback()
+                return True
+            db.execute("CREATE TABLE search_sessions (id INTEGER PRIMARY KEY, session_id TEXT NOT NULL UNIQUE)")
+            db.execute(
+                "CREATE VIRTUAL TABLE message_index USING fts5("
+                "message, sender UNINDEXED, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            )
+            indexed = db.execute("INSERT INTO search_sessions (session_id) SELECT DISTINCT session_id FROM messages")
+            if indexed.rowcount:
+                print(f"Indexing the messages of {indexed.rowcount} conversations for search")
+                db.execute(
+                    "INSERT INTO message_index (rowid, message, sender) "
+                    "SELECT (s.id << 32) + m.seq, m.message, m.sender FROM messages m JOIN search_sessions s USING (session_id) "
+                    "ORDER BY 1"
+                )
+            db.commit()
+            return True
+        except sqlite3.OperationalError as e:
+            # SQLite built without FTS5
+            db.rollback()
+            print(f"Search disabled: {e}")
+            return False
+
+    def append(self, session_id, seq, sender, message):
+        if not self.shared:
+            with self._pending_lock:
+                self._pending.setdefault(session_id, {})[seq] = (seq, sender, message)
+            self._queue.put((session_id, seq, sender, message))
+            return
+        with self._read_lock:
+            try:
+                with self._reader:
+                    self._reader.execute(
+                        "INSERT INTO messages (session_id, seq, sender, message) VALUES (?, ?, ?, ?)",
+                        (session_id, seq, sender, message),
+                    )
+                    if self.searchable:
+                        self._index(self._reader, [(session_id, seq, sender, message)])
+            except sqlite3.IntegrityError:
+                raise SeqTaken(session_id, seq) from None
+
+    def load_recent(self, session_id, limit, before=None):
+        # Walks the (session_id, seq) primary key backwards; never reads the full history
+        if before is None:
+            before = 2 ** 62
+        # Taken before the read: a row committed in between is then found in one or both
+        pending = [row for row in self._queued(session_id) if row[0] < before]
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT seq, sender, message FROM messages WHERE session_id = ? AND seq < ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (session_id, before, limit),
+            ).fetchall()
+        rows.reverse()
+        if pending:
+            rows = sorted({row[0]: row for row in rows + pending}.values())[-limit:]
+        return rows
+
+    def latest_seq(self, session_id):
+        pending = self._queued(session_id)
+        with self._read_lock:
+            latest = self._reader.execute(
+                "SELECT MAX(seq) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+        return max([row[0] for row in pending] + ([] if latest is None else [latest]), default=None)
+
+    def _queued(self, session_id):
+        with self._pending_lock:
+            return list(self._pending.get(session_id, {}).values())
+
+    def save_summary(self, session_id, upto_seq, summary):
+        # Rare and off the request path, so written directly rather than queued
+        with self._read_lock, self._reader:
+            self._reader.execute(
+                "INSERT INTO summaries (session_id, upto_seq, summary) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET upto_seq = excluded.upto_seq, summary = excluded.summary "
+                "WHERE excluded.upto_seq > summaries.upto_seq",
+                (session_id, upto_seq, summary),
+            )
+
+    def search(self, session_id, terms, limit=20, offset=0):
+        """Ranked by BM25 over the statistics of this conversation, scored
+        by SQLite rather than with FTS5's bm25(), which weighs each term by
+        scanning every row of the table that contains it: that cost grows
+        with the whole store. How often a term occurs in a match is counted
+        from the marks highlight() adds, and lengths come from the index's
+        per-row token counts. The newest `max_ranked` matches are ranked;
+        older ones follow them, newest first."""
+        if not self.searchable:
+            return []
+        match = match_expression(terms)
+        with self._read_lock:
+            row = self._reader.execute("SELECT id FROM search_sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return []
+            first, last = row[0] << 32, (row[0] << 32) | 0xFFFFFFFF
+            where = "message_index MATCH :match AND rowid BETWEEN :first AND :last"
+            if len(terms) == 1:
+                # A single term's weight scales every score alike
+                weights = [1.0]
+            else:
+                counts = [
+                    self._reader.execute(f"SELECT COUNT(*) FROM message_index WHERE {where}",
+                                         {"match": match_expression([term]), "first": first, "last": last}).fetchone()[0]
+                    for term in terms
+                ]
+                if not min(counts):
+                    return []
+                total = self._reader.execute(
+                    "SELECT COUNT(*) FROM message_index WHERE rowid BETWEEN ? AND ?", (first, last)
+                ).fetchone()[0]
+                weights = term_weights(total, counts)
+            params = {"match": match, "first": first, "last": last, "ranked": self.max_ranked,
+                      "mark": MATCH_START, "limit": limit, "offset": offset}
+            params.update({f"weight{i}": weight for i, weight in enumerate(weights)})
+            params.update({f"term{i}": match_expression([term]) for i, term in enumerate(terms)})
+            page = [rowid for (rowid,) in self._reader.execute(self._rank_query(len(terms)), params)]
+            if len(page) < limit and offset + limit > self.max_ranked:
+                # Past the ranked matches, the older ones newest first
+                params.update(limit=limit - len(page), offset=max(offset, self.max_ranked))
+                page += [rowid for (rowid,) in self._reader.execute(
+                    f"SELECT rowid FROM message_index WHERE {where} ORDER BY rowid DESC LIMIT :limit OFFSET :offset",
+                    params,
+                )]
+            if not page:
+                return []
+            snippets = {
+                rowid: (sender, snippet)
+                for rowid, sender, snippet in self._reader.execute(
+                    "SELECT rowid, sender, snippet(message_index, 0, ?, ?, '…', 24) FROM message_index "
+                    # A range FTS5 seeks to once; a plain IN would restart the query for every rowid
+                    f"WHERE message_index MATCH ? AND rowid BETWEEN ? AND ? AND +rowid IN ({', '.join('?' * len(page))})",
+                    (MATCH_START, MATCH_END, match, min(page), max(page), *page),
+                )
+            }
+        return [(rowid & 0xFFFFFFFF, *snippets[rowid]) for rowid in page]
+
+    @staticmethod
+    def _rank_query(count):
+        """SQL for a page of the newest `:ranked` matches, best first; ties go to the newest"""
+        # Only an opening mark is added per occurrence, so the text grows by one character each
+        tf = "length(highlight({0}, 0, :mark, '')) - length(message)"
+        if count == 1:
+            tfs = tf.format("matches.message_index") + " AS tf0"
+        else:
+            # Each term is counted by looking the message up with that term alone
+            tfs = ", ".join(
+                f"(SELECT {tf.format('message_index')} FROM message_index "
+                f"WHERE message_index MATCH :term{i} AND rowid = matches.rowid) AS tf{i}"
+                for i in range(count)
+            )
+        return (
+            f"SELECT rowid FROM (SELECT *, AVG(size) OVER () AS average FROM ("
+            "SELECT rowid, token_count((SELECT sz FROM message_index_docsize WHERE id = matches.rowid)) AS size, "
+            f"{tfs} FROM message_index AS matches "
+            "WHERE matches.message_index MATCH :match AND rowid BETWEEN :first AND :last ORDER BY rowid DESC LIMIT :ranked)) "
+            f"ORDER BY {score_expression(count)} DESC, rowid DESC LIMIT :limit OFFSET :offset"
+        )
+
+    def load_summary(self, session_id):
+        with self._read_lock:
+            return self._reader.execute(
+                "SELECT upto_seq, summary FROM summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+
+    def flush(self):
+        """Block until every queued append has been committed"""
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        with self._read_lock:
+            self._reader.close()
+
+    def _index(self, db, rows):
+        """Add (session_id, seq, sender, message) rows to the search index, in the caller's transaction.
+
+        Rows go in by ascending rowid: FTS5 flushes the terms it has
+        gathered in memory whenever a rowid is lower than the previous one
+        in the transaction, which interleaved conversations would otherwise
+        cause on almost every row.
+        """
+        sessions = list(dict.fromkeys(row[0] for row in rows))
+        db.executemany("INSERT OR IGNORE INTO search_sessions (session_id) VALUES (?)", [(s,) for s in sessions])
+        ids = dict(db.execute(
+            f"SELECT session_id, id FROM search_sessions WHERE session_id IN ({', '.join('?' * len(sessions))})",
+            sessions,
+        ))
+        entries = [((ids[session_id] << 32) + seq, message, sender) for session_id, seq, sender, message in rows]
+        entries.sort(key=lambda entry: entry[0])
+        db.executemany("INSERT INTO message_index (rowid, message, sender) VALUES (?, ?, ?)", entries)
+
+    def _store(self, db, rows):
+        """Commit (session_id, seq, sender, message) rows in one transaction.
+
+        A seq that is already stored fails the batch, which is then retried
+        a row at a time so only the duplicate is dropped.
+        """
+        insert = "INSERT INTO messages (session_id, seq, sender, message) VALUES (?, ?, ?, ?)"
+        try:
+            with db:
+                db.executemany(insert, rows)
+                if self.searchable:
+                    self._index(db, rows)
+            return
+        except sqlite3.IntegrityError:
+            pass
+        with db:
+            stored = []
+            for row in rows:
+                try:
+                    db.execute(insert, row)
+                except sqlite3.IntegrityError:
+                    print(f"Conversation persistence error: seq {row[1]} of {row[0]} is already stored")
+                    continue
+                stored.append(row)
+            if self.searchable and stored:
+                self._index(db, stored)
+
+    def _write_loop(self):
+        db = self._connect()
+        try:
+            while True:
+                batch = [self._queue.get()]
+                # Gather whatever else arrives within the batch window
+                deadline = time.monotonic() + self.batch_delay
+                try:
+                    while len(batch) < self.batch_size and batch[-1] is not None:
+                        batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    pass
+
+                stop = batch[-1] is None
+                rows = [row for row in batch if row is not None]
+                if rows:
+                    try:
+                        self._store(db, rows)
+                    except sqlite3.Error as e:
+                        print(f"Conversation persistence error: {e}")
+                    with self._pending_lock:
+                        for session_id, seq, _, _ in rows:
+                            pending = self._pending.get(session_id)
+                            if pending is not None and pending.pop(seq, None) is not None and not pending:
+                                del self._pending[session_id]
+                for _ in batch:
+                    self._queue.task_done()
+                if stop:
+                    break
+        finally:
+            db.close()
@@ -0,0 +1,240 @@
+import re
+from html import escape
+from xml.etree import ElementTree
+
+try:
+    from markdown_it import MarkdownIt
+    from mdit_py_plugins.dollarmath import dollarmath_plugin
+except ImportError:  # markdown-it-py is optional; without it answers render in the browser
+    MarkdownIt = None
+
+try:
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import TextLexer, get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:  # pygments is optional; code blocks are then left unhighlighted
+    highlight = None
+
+try:
+    from latex2mathml.converter import convert as latex_to_mathml
+except ImportError:  # latex2mathml is optional; math is then left to KaTeX in the browser
+    latex_to_mathml = None
+
+AVAILABLE = MarkdownIt is not None
+
+CODE_CLASS = "md-code"
+FENCE = re.compile(r" {0,3}(`{3,}|~{3,})")
+# Lines that carry a list or blockquote on across a blank line, when the
+# next line starts the same kind
+LIST_ITEM = re.compile(r"([-+*])(?:[ \t]|$)|\d{1,9}([.)])(?:[ \t]|$)")
+THEMATIC_BREAK = re.compile(r" {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+# Link reference definitions apply to the whole answer, wherever they are
+REFERENCE = re.compile(r"^ {0,3}\[[^\]]+\]:", re.MULTILINE)
+# What converted math may contain. latex2mathml copies commands such as
+# \style, \class and \href into attributes, so anything else is dropped
+MATHML = "http://www.w3.org/1998/Math/MathML"
+MATHML_TAGS = {
+    "math", "mrow", "mi", "mn", "mo", "ms", "mtext", "mspace", "msub", "msup", "msubsup", "munder", "mover",
+    "munderover", "mfrac", "msqrt", "mroot", "mstyle", "mtable", "mtr", "mtd", "mpadded", "mphantom",
+    "menclose", "mmultiscripts", "mprescripts", "none", "semantics", "annotation",
+}
+MATHML_ATTRIBUTES = {
+    "display", "displaystyle", "scriptlevel", "mathvariant", "mathcolor", "mathbackground", "mathsize",
+    "stretchy", "fence", "separator", "form", "accent", "accentunder", "movablelimits", "largeop", "symmetric",
+    "lspace", "rspace", "minsize", "maxsize", "width", "height", "depth", "voffset", "linethickness", "notation",
+    "columnalign", "rowalign", "columnlines", "rowlines", "columnspacing", "rowspacing", "frame", "encoding",
+}
+# Text-mode groups, whose contents latex2mathml copies into <mtext> unescaped.
+# Markup characters in them are swapped for private-use stand-ins, which
+# come back as text once the MathML has been parsed.
+TEXT_GROUP = re.compile(r"\\(?:text[a-z]*|[mhf]box)\s*\{[^{}]*\}")
+HIDE_MARKUP = str.maketrans("<>&", "\ue000\ue001\ue002")
+SHOW_MARKUP = str.maketrans("\ue000\ue001\ue002", "<>&")
+
+
+def _continues(line):
+    """The list marker or blockquote an unindented line starts, if any"""
+    if line.startswith(">"):
+        return ">"
+    match = LIST_ITEM.match(line)
+    if match is None or THEMATIC_BREAK.match(line):
+        return None
+    return match.group(1) or match.group(2)
+
+
+def block_ends(text, start=0):
+    """Offsets in `text` where finished top-level markdown blocks end, scanning from `start`.
+
+    A block is finished once a blank line is followed by a whole unindented
+    line, outside any code fence or `$$` math block, unless that line is
+    another item of the same list (or another `>` line after a blockquote).
+    Only that much lookahead is needed, so a prefix of an answer splits
+    exactly like the whole answer does.
+    """
+    ends = []
+    fence = None
+    in_math = False
+    blank = False
+    container = None
+    pos = start
+    while pos < len(text):
+        nl = text.find("\n", pos)
+        if nl == -1:
+            break
+        line = text[pos:nl]
+        if fence is None and not in_math and line[:1] not in ("", " ", "\t"):
+            kind = _continues(line)
+            if blank and (kind is None or kind != container):
+                ends.append(pos)
+                container = None
+            container = kind or container
+
+        stripped = line.strip()
+        if fence is not None:
+            if stripped.startswith(fence) and set(stripped) == {fence[0]}:
+                fence = None
+        elif in_math:
+            in_math = not stripped.endswith("$$")
+        elif match := FENCE.match(line):
+            fence = match.group(1)
+        elif stripped.startswith("$$"):
+            in_math = len(stripped) == 2 or not stripped.endswith("$$")
+        blank = not stripped
+        pos = nl + 1
+    return ends
+
+
+def split_blocks(text):
+    """Sources of the top-level blocks of a finished answer; one block if
+    it has link reference definitions"""
+    if REFERENCE.search(text):
+        return [text]
+    blocks = []
+    start = 0
+    for end in block_ends(text):
+        blocks.append(text[start:end])
+        start = end
+    if text[start:].strip():
+        blocks.append(text[start:])
+    return blocks
+
+
+def _highlight(code, lang, attrs):
+    if highlight is None:
+        return ""  # markdown-it escapes it into a plain <pre><code>
+    try:
+        lexer = get_lexer_by_name(lang) if lang else TextLexer()
+    except ClassNotFound:
+        lexer = TextLexer()
+    lang_class = f" language-{escape(lang)}" if lang else ""
+    # Marked as highlighted so highlight.js in the browser leaves it alone
+    return (f'<pre><code class="{CODE_CLASS}{lang_class}" data-highlighted="yes">'
+            f'{highlight(code, lexer, HtmlFormatter(nowrap=True))}</code></pre>\n')
+
+
+def _sanitize_mathml(markup):
+    """`markup` with only known MathML elements and presentation attributes,
+    or None if it is not well-formed or has anything else. Stand-ins for
+    markup characters in text become those characters, escaped."""
+    try:
+        root = ElementTree.fromstring(markup)
+    except ElementTree.ParseError:
+        return None
+    for element in root.iter():
+        namespace, _, tag = element.tag.rpartition("}")
+        if namespace != "{" + MATHML or tag not in MATHML_TAGS:
+            return None
+        element.tag = tag
+        if element.text:
+            element.text = element.text.translate(SHOW_MARKUP)
+        if element.tail:
+            element.tail = element.tail.translate(SHOW_MARKUP)
+        for name in list(element.attrib):
+            if name not in MATHML_ATTRIBUTES:
+                del element.attrib[name]
+    root.set("xmlns", MATHML)
+    return ElementTree.tostring(root, encoding="unicode")
+
+
+def _math(tex, options):
+    display = options["display_mode"]
+    if latex_to_mathml is not None:
+        try:
+            safe = TEXT_GROUP.sub(lambda group: group[0].translate(HIDE_MARKUP), tex)
+            mathml = _sanitize_mathml(latex_to_mathml(safe, display="block" if display else "inline"))
+            if mathml is not None:
+                return mathml
+        except Exception:
+            pass  # unsupported TeX; fall through to KaTeX in the browser
+    delimiter = "$$" if display else "$"
+    return f'<span class="math-tex">{escape(delimiter + tex + delimiter)}</span>'
+
+
+if AVAILABLE:
+    # Raw HTML in answers is escaped, never passed through
+    _md = (
+        MarkdownIt("commonmark", {"html": False, "highlight": _highlight})
+        .enable(["table", "strikethrough"])
+        .use(dollarmath_plugin, renderer=_math, allow_labels=False, allow_digits=False)
+    )
+
+
+def render_markdown(source):
+    """HTML for a markdown source, with code highlighted and math converted to MathML"""
+    return _md.render(source)
+
+
+def code_css(style="github-dark"):
+    """Stylesheet for highlighted code blocks"""
+    if highlight is None:
+        return ""
+    rules = HtmlFormatter(style=style).get_style_defs(f".{CODE_CLASS}").splitlines()
+    return "\n".join(rule for rule in rules if rule.startswith(f".{CODE_CLASS}"))
+
+
+class BlockStream:
+    """A streaming answer rendered one finished block at a time.
+
+    Finished blocks are rendered once through `render`, which callers
+    cache; only the trailing partial block is re-rendered as text arrives.
+    """
+
+    def __init__(self, render):
+        self.render = render
+        self.text = ""
+        self.start = 0
+        self.html = []
+        self.replaced = False
+
+    def feed(self, delta):
+        """Add `delta` and return the HTML of any blocks it finished"""
+        self.text += delta
+        new = []
+        for end in block_ends(self.text, self.start):
+            new.append(self.render(self.text[self.start:end]))
+            self.start = end
+        self.html.extend(new)
+        return new
+
+    def tail(self):
+        """HTML of the unfinished trailing block"""
+        source = self.text[self.start:]
+        return render_markdown(source) if source.strip() else ""
+
+    def close(self):
+        """Finish the trailing block and return its HTML, if any.
+
+        If the answer has link reference definitions, which blocks already
+        sent were rendered without, it becomes one block and `replaced` is set.
+        """
+        source = self.text[self.start:]
+        self.start = len(self.text)
+        if REFERENCE.search(self.text):
+            self.html = [self.render(self.text)]
+            self.replaced = True
+            return self.html
+        if not source.strip():
+            return []
+        self.html.append(self.render(source))
+        return self.html[-1:]
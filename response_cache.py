@@ -0,0 +1,172 @@
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def cache_key(api_messages, params):
+    """Stable hash of the normalized prompt and model parameters"""
+    normalized = [
+        (m["role"], m["content"].replace("\r\n", "\n").strip())
+        for m in api_messages
+    ]
+    payload = json.dumps([normalized, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def replay_chunks(text, size=256):
+    """Split a cached response into chunks for the normal streaming protocol"""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class ResponseCache:
+    """Completed model responses keyed by prompt hash.
+
+    An in-memory LRU tier bounded by `max_bytes` and `ttl`, backed by an
+    optional SQLite file at `path` so cached answers survive restarts. The
+    file is bounded by `ttl` and by `max_disk_bytes` of response text,
+    oldest entries evicted first.
+    Disk reads and writes run in a worker thread to keep the event loop free.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=3600, path=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if path:
+            with self._db() as db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses "
+                    "(key TEXT PRIMARY KEY, response TEXT NOT NULL, expires REAL NOT NULL, size INTEGER NOT NULL DEFAULT 0)"
+                )
+                if "size" not in [column[1] for column in db.execute("PRAGMA table_info(responses)")]:
+                    # Files written before the size bound
+                    db.execute("ALTER TABLE responses ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                    db.execute("UPDATE responses SET size = length(CAST(response AS BLOB))")
+                # Sizes in expiry order without reading the responses
+                db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires, size)")
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    async def get(self, key):
+        """Return the cached response for `key`, or None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, response = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                self._remove(key)
+
+        if self.path:
+            response = await asyncio.to_thread(self._disk_get, key, now)
+            if response is not None:
+                with self._lock:
+                    self._store(key, response, now + self.ttl)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return response
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def put(self, key, response):
+        """Cache a completed response"""
+        if not self.enabled or not response:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._store(key, response, expires)
+        if self.path:
+            await asyncio.to_thread(self._disk_put, key, response, expires)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+            }
+
+    # Memory tier; callers must hold self._lock
+
+    def _store(self, key, response, expires):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires, response)
+        self._bytes += sys.getsizeof(response)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self._bytes -= sys.getsizeof(response)
+
+    # Disk tier; runs in a worker thread
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=5)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _disk_get(self, key, now):
+        with self._db() as db:
+            row = db.execute(
+                "SELECT response FROM responses WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _disk_put(self, key, response, expires):
+        with self._db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, expires, size) VALUES (?, ?, ?, ?)",
+                (key, response, expires, len(response.encode())),
+            )
+            db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+            excess = db.execute("SELECT SUM(size) FROM responses").fetchone()[0] - self.max_disk_bytes
+            if excess <= 0:
+                return
+            # Every entry lives `ttl`, so the soonest to expire is the oldest
+            evicted = []
+            for rowid, size in db.execute(
+                "SELECT rowid, size FROM responses WHERE key != ? ORDER BY expires", (key,)
+            ):
+                if excess <= 0:
+                    break
+                evicted.append((rowid,))
+                excess -= size
+            db.executemany("DELETE FROM responses WHERE rowid = ?", evicted)
+        with self._lock:
+            self.disk_evictions += len(evicted)
@@ -0,0 +1,234 @@
+import random
+import asyncio
+from collections import OrderedDict, deque
+
+from openai import APIConnectionError, APIStatusError
+
+
+def is_retryable(error):
+    """Rate limits, server errors and connection failures are worth retrying"""
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, APIConnectionError)
+
+
+def retry_after(error):
+    """Seconds the provider asked us to wait, if it said"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # HTTP-date form; fall back to our own backoff
+    return None
+
+
+class SharedStream:
+    """Chunks of one upstream response, replayable by any number of subscribers"""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = None
+
+    def push(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set_result(None)
+            self._changed = None
+
+    async def subscribe(self):
+        """Yield every chunk from the start, then new ones as they arrive"""
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            if self._changed is None:
+                self._changed = asyncio.get_running_loop().create_future()
+            await asyncio.shield(self._changed)
+
+
+class UpstreamScheduler:
+    """Admission control in front of the model provider.
+
+    Upstream calls are capped globally (`max_concurrent`) and per session
+    (`per_session`). Callers over the cap wait in a fair queue that serves
+    sessions round-robin, so one busy session cannot starve the others.
+    Calls failing with 429/5xx or a connection error are retried with
+    jittered exponential backoff, honouring Retry-After, as long as no
+    output has been streamed yet. A call waiting to retry holds no slot,
+    and one asked to wait longer than `backoff_max` fails at once.
+    Identical in-flight requests (same key) share a single upstream stream.
+    """
+
+    def __init__(self, max_concurrent=32, per_session=2, max_retries=3, backoff_base=0.5, backoff_max=20.0,
+                 on_retry=None):
+        self.max_concurrent = max_concurrent
+        self.per_session = per_session
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.on_retry = on_retry
+        self.active = 0
+        self.coalesced = 0
+        self._session_active = {}
+        # session id -> FIFO of waiting futures; dict order is the round-robin order
+        self._waiters = OrderedDict()
+        self._flights = {}
+
+    @property
+    def waiting(self):
+        return sum(len(q) for q in self._waiters.values())
+
+    def queue_position(self, session_id):
+        """Estimated place in the queue for a new request (0 means it runs now)"""
+        if self._can_run(session_id) and not self._waiters:
+            return 0
+        return self.waiting + 1
+
+    async def stream(self, key, session_id, open_upstream):
+        """Yield the response chunks for `key`, starting an upstream call if none is in flight.
+
+        `open_upstream()` must return an async iterable of text chunks. When
+        the last subscriber goes away the upstream call is cancelled.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = SharedStream()
+            flight.task = asyncio.create_task(self._produce(key, session_id, open_upstream, flight))
+        else:
+            self.coalesced += 1
+
+        flight.subscribers += 1
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is listening any more; stop paying for tokens
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    async def _produce(self, key, session_id, open_upstream, flight):
+        try:
+            attempt = 0
+            while True:
+                await self._acquire(session_id)
+                try:
+                    async for chunk in open_upstream():
+                        flight.push(chunk)
+                    break
+                except Exception as e:
+                    if flight.chunks or attempt >= self.max_retries or not is_retryable(e):
+                        raise
+                    delay = self._backoff(attempt + 1, retry_after(e))
+                    if delay is None:
+                        raise
+                    attempt += 1
+                    if self.on_retry:
+                        self.on_retry(e)
+                finally:
+                    self._release(session_id)
+                # Back of the queue once the wait is over; others run meanwhile
+                await asyncio.sleep(delay)
+            flight.finish()
+        except asyncio.CancelledError:
+            flight.finish(RuntimeError("Upstream request cancelled"))
+            raise
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _backoff(self, attempt, hint):
+        """Seconds to wait before retry `attempt`, or None if the provider
+        asked for longer than `backoff_max`"""
+        if hint is not None and hint > self.backoff_max:
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, hint) if hint is not None else delay
+
+    # Fair queue
+
+    def _can_run(self, session_id):
+        return self.active < self.max_concurrent and self._session_active.get(session_id, 0) < self.per_session
+
+    async def _acquire(self, session_id):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session_id, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled; hand the slot back
+                self._release(session_id)
+            else:
+                self._discard(session_id, future)
+            raise
+
+    def _release(self, session_id):
+        self.active -= 1
+        remaining = self._session_active[session_id] - 1
+        if remaining:
+            self._session_active[session_id] = remaining
+        else:
+            del self._session_active[session_id]
+        self._dispatch()
+
+    def _discard(self, session_id, future):
+        queue = self._waiters.get(session_id)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._waiters[session_id]
+
+    def _dispatch(self):
+        while self.active < self.max_concurrent:
+            session_id = next(
+                (sid for sid in self._waiters if self._session_active.get(sid, 0) < self.per_session), None
+            )
+            if session_id is None:
+                return
+            queue = self._waiters.pop(session_id)
+            future = queue.popleft()
+            if queue:
+                # Back of the rotation, behind every other waiting session
+                self._waiters[session_id] = queue
+            if future.done():
+                continue
+            self.active += 1
+            self._session_active[session_id] = self._session_active.get(session_id, 0) + 1
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "in_flight": len(self._flights),
+            "coalesced": self.coalesced,
+        }
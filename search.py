@@ -0,0 +1,66 @@
+import re
+import math
+import unicodedata
+from html import escape
+
+# Snippets come back from the index with matches between these, so the
+# message text can be escaped before the markers become <mark> tags
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+_TERM = re.compile(r'"([^"]*)"(\*?)|(\S+)')
+_WORD = re.compile(r"[^\W_]+")
+
+
+def parse_query(text, min_prefix=2):
+    """(phrase, prefix) terms of a search box query; empty if it has none.
+
+    Every term must match. `"..."` matches a phrase, and a trailing `*`
+    makes the last word a prefix, as in `strea* "server side"`. Prefixes
+    shorter than `min_prefix` characters match whole words instead; they
+    would merge the doclists of thousands of terms.
+    """
+    terms = []
+    for phrase, star, word in _TERM.findall(text):
+        if word:
+            phrase = word.rstrip("*")
+            star = "*" if word.endswith("*") else ""
+        words = tokens(phrase)
+        if not words:
+            continue
+        terms.append((" ".join(words), bool(star) and len(words[-1]) >= min_prefix))
+    return terms
+
+
+def match_expression(terms):
+    """FTS5 MATCH expression for parsed terms. Everything is quoted, so
+    FTS5 operators typed by the user are searched as plain words."""
+    return " ".join(f'"{phrase}"' + ("*" if prefix else "") for phrase, prefix in terms)
+
+
+def tokens(text):
+    """Words of `text` the way the index's unicode61 tokenizer sees them:
+    case-folded and without diacritics"""
+    text = text.casefold()
+    if not text.isascii():
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return _WORD.findall(text)
+
+
+def term_weights(total, counts):
+    """BM25 weight of each term, from the number of messages searched and
+    how many of them contain it"""
+    return [math.log(1 + (total - n + 0.5) / (n + 0.5)) for n in counts]
+
+
+def score_expression(count, k1=1.2, b=0.75):
+    """SQL for the BM25 score of a match, given columns `tf0`.. with how
+    often each of `count` terms occurs in it, `size` and the `average` size
+    of the matches, and parameters `:weight0`.. from `term_weights`"""
+    norm = f"{k1} * (1 - {b} + {b} * size / average)"
+    return " + ".join(f":weight{i} * tf{i} * {k1 + 1} / (tf{i} + {norm})" for i in range(count))
+
+
+def snippet_html(snippet):
+    """Escape an index snippet and highlight its matches"""
+    return escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
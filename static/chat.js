@@ -0,0 +1,430 @@
+// Chat page client: scrolling, input handling, code highlighting and math
+// rendering, and sending messages and rendering streamed replies. Shared by
+// every page and message, and cached by the browser.
+//
+// Two transports feed the same reply view:
+//  - single request (default): the form is POSTed to /chat with fetch, and the
+//    response carries the message bubbles followed by the reply's SSE events
+//  - two requests: htmx POSTs to /send_message, then an EventSource is opened
+//    on /stream-response for the placeholder it returned
+(function() {
+    // Start at the bottom before htmx initialises, so older history only
+    // loads once the user scrolls up to it. A search result link opens the
+    // page around one message instead, scrolled to that message.
+    function scrollToStart() {
+        const chatMessages = document.getElementById('chat-messages');
+        const target = location.hash && document.getElementById(location.hash.slice(1));
+        if (target && chatMessages.contains(target)) target.scrollIntoView({ block: 'center' });
+        else chatMessages.scrollTop = chatMessages.scrollHeight;
+    }
+    scrollToStart();
+
+    // Again once images and fonts have loaded and moved things around
+    window.onload = () => {
+        scrollToStart();
+
+        // Initialize KaTeX for existing content
+        const existingZeroMd = document.querySelectorAll('zero-md, .markdown-body:has(.math-tex)');
+        existingZeroMd.forEach(element => {
+            setTimeout(() => renderKaTeX(element), 200);
+        });
+    };
+
+    // Function to highlight code blocks in zero-md content
+    function highlightCodeBlocks(container) {
+        if (typeof hljs !== 'undefined') {
+            const codeBlocks = container.querySelectorAll('pre code:not([data-highlighted="yes"])');
+            codeBlocks.forEach(block => {
+                hljs.highlightElement(block);
+            });
+        }
+    }
+
+    // Function to render KaTeX math expressions in zero-md content
+    function renderKaTeX(container) {
+        function doRender() {
+            if (typeof renderMathInElement !== 'undefined') {
+                const target = container.shadowRoot || container;
+                try {
+                    renderMathInElement(target, {
+                        delimiters: [
+                            {left: '$$', right: '$$', display: true},
+                            {left: '$', right: '$', display: false},
+                            {left: '\\(', right: '\\)', display: false},
+                            {left: '\\[', right: '\\]', display: true}
+                        ],
+                        throwOnError: false
+                    });
+                } catch (e) {
+                    console.error('KaTeX rendering error:', e);
+                }
+            }
+        }
+
+        // Use requestAnimationFrame for better timing
+        if (window.katexLoaded || typeof renderMathInElement !== 'undefined') {
+            requestAnimationFrame(() => {
+                requestAnimationFrame(doRender); // Double RAF for stability
+            });
+        } else {
+            // Fallback with timeout
+            setTimeout(() => renderKaTeX(container), 100);
+        }
+    }
+
+    // Observer to highlight code and render KaTeX when zero-md content loads
+    const observer = new MutationObserver((mutations) => {
+        mutations.forEach((mutation) => {
+            mutation.addedNodes.forEach((node) => {
+                if (node.nodeType === Node.ELEMENT_NODE) {
+                    // Check if it's a zero-md element or contains one
+                    const zeroMdElements = node.tagName === 'ZERO-MD' ? [node] : node.querySelectorAll ? node.querySelectorAll('zero-md, .markdown-body:has(.math-tex)') : [];
+                    zeroMdElements.forEach((zeroMd) => {
+                        // Use requestAnimationFrame instead of setTimeout
+                        requestAnimationFrame(() => {
+                            highlightCodeBlocks(zeroMd);
+                            renderKaTeX(zeroMd);
+                        });
+                    });
+                }
+            });
+        });
+    });
+    // Only observe the chat messages container instead of entire document
+    const chatContainer = document.getElementById('chat-messages');
+    if (chatContainer) {
+        observer.observe(chatContainer, { childList: true, subtree: true });
+    }
+
+    // Auto-resize textarea
+    document.addEventListener('input', (e) => {
+        if (e.target.tagName === 'TEXTAREA') {
+            e.target.style.height = 'auto';
+            e.target.style.height = (e.target.scrollHeight) + 'px';
+        }
+    });
+
+    // Handle Enter key (submit) vs Shift+Enter (new line)
+    document.addEventListener('keydown', (e) => {
+        if (e.target.tagName === 'TEXTAREA' && e.key === 'Enter' && !e.shiftKey) {
+            e.preventDefault();
+            const form = e.target.closest('form');
+            // Only submit if not processing
+            if (!form.getAttribute('data-processing')) {
+                form.requestSubmit();
+            }
+        }
+    });
+
+    // Handle form submission - disable button and set processing flag
+    document.addEventListener('submit', (e) => {
+        if (e.target.id === 'chat-form') {
+            if (e.target.getAttribute('data-processing')) {
+                e.preventDefault();
+            } else {
+                // Disable button and set processing flag
+                const submitBtn = document.getElementById('submit-btn');
+                submitBtn.disabled = true;
+                e.target.setAttribute('data-processing', 'true');
+            }
+        }
+    });
+
+    // Clear textarea on successful form submit
+    document.addEventListener('htmx:afterRequest', (e) => {
+        if (e.target.id === 'chat-form' && e.detail.successful) {
+            const textarea = e.target.querySelector('textarea');
+            textarea.value = '';
+            textarea.style.height = 'auto';
+        }
+    });
+
+    // Time of the keypress/click that sent the current message, for TTFT
+    let sentAt = 0;
+    window.chatTimings = window.chatTimings || [];
+
+    function reenableForm() {
+        const form = document.getElementById('chat-form');
+        const submitBtn = document.getElementById('submit-btn');
+        form.removeAttribute('data-processing');
+        submitBtn.disabled = false;
+    }
+
+    // Rendering state for one streamed reply
+    function replyView(messageId, mode) {
+        let fullContent = '';
+
+        // Deltas are appended to fullContent and rendered at most once per
+        // animation frame, so zero-md re-parses per frame rather than per event
+        let renderScheduled = false;
+        let renderStart = 0;
+        const stats = { events: 0, renders: 0, renderMs: 0 };
+        const startedAt = sentAt;
+        const zeroMdElement = document.getElementById(messageId);
+        const scriptElement = zeroMdElement && zeroMdElement.querySelector('script[type="text/markdown"]');
+
+        // Server-rendered replies arrive as HTML: finished blocks are appended
+        // once, and only the trailing partial block is replaced
+        const serverRendered = zeroMdElement && zeroMdElement.dataset.render === 'server';
+        let pendingBlocks = [];
+        let pendingTail = null;
+        function queueHtml(data) {
+            pendingBlocks.push(...(data.blocks || []));
+            if (data.tail !== undefined) pendingTail = data.tail;
+        }
+        if (zeroMdElement) {
+            zeroMdElement.addEventListener('zero-md-rendered', () => {
+                if (renderStart) {
+                    stats.renderMs += performance.now() - renderStart;
+                    renderStart = 0;
+                }
+            });
+        }
+
+        function render() {
+            renderScheduled = false;
+            if (serverRendered) {
+                if (pendingBlocks.length || pendingTail !== null) {
+                    stats.renders++;
+                    zeroMdElement.firstElementChild.insertAdjacentHTML('beforeend', pendingBlocks.join(''));
+                    if (pendingTail !== null) zeroMdElement.lastElementChild.innerHTML = pendingTail;
+                    pendingBlocks = [];
+                    pendingTail = null;
+                }
+            } else if (scriptElement && scriptElement.textContent !== fullContent) {
+                renderStart = renderStart || performance.now();
+                stats.renders++;
+                scriptElement.textContent = fullContent;
+            }
+        }
+
+        function scheduleRender() {
+            if (!renderScheduled) {
+                renderScheduled = true;
+                requestAnimationFrame(render);
+            }
+        }
+
+        // Hide typing indicator and show content
+        let contentShown = false;
+        function showContent() {
+            if (contentShown) return;
+            contentShown = true;
+            const typingDiv = document.getElementById('typing-' + messageId);
+            const contentDiv = document.getElementById('content-' + messageId);
+            if (typingDiv) typingDiv.style.display = 'none';
+            if (contentDiv) contentDiv.style.display = 'block';
+        }
+
+        function recordFirstToken() {
+            if (stats.ttft !== undefined || !startedAt) return;
+            stats.ttft = performance.now() - startedAt;
+            window.chatTimings.push({ mode: mode, messageId: messageId, ttft: stats.ttft });
+            console.info('[ttft] ' + mode + ' ' + messageId + ': ' + stats.ttft.toFixed(0) + 'ms from keypress');
+        }
+
+        function finish() {
+            if (serverRendered) {
+                // Code is already highlighted; KaTeX only handles math the server left as TeX
+                if (zeroMdElement.querySelector('.math-tex')) renderKaTeX(zeroMdElement);
+            } else if (typeof hljs !== 'undefined') {
+                const codeBlocks = zeroMdElement.querySelectorAll('pre code');
+                codeBlocks.forEach(block => {
+                    hljs.highlightElement(block);
+                });
+            }
+            if (!serverRendered) renderKaTeX(zeroMdElement);
+            console.debug('[stream] ' + messageId + ': ' + stats.events + ' events, ' +
+                stats.renders + ' renders, ' + stats.renderMs.toFixed(1) + 'ms rendering');
+        }
+
+        // Handle one SSE data payload; returns true once the reply is over
+        return function handle(raw) {
+            stats.events++;
+            if (raw === '[DONE]') {
+                reenableForm();
+                return true;
+            }
+
+            try {
+                const data = JSON.parse(raw);
+
+                if (data.type === 'start') {
+                    if (data.queue_position > 0) {
+                        // Keep the typing indicator up while waiting for an upstream slot
+                        const label = document.querySelector('#typing-' + messageId + ' span');
+                        if (label) label.textContent = 'Queued (position ' + data.queue_position + ')';
+                    } else {
+                        showContent();
+                    }
+                } else if (data.type === 'chunk') {
+                    showContent();
+                    recordFirstToken();
+                    if (serverRendered) queueHtml(data);
+                    else fullContent += data.content;
+                    // Don't render KaTeX during streaming to avoid incomplete expressions
+                    scheduleRender();
+                } else if (data.type === 'snapshot') {
+                    // Resumed too far behind for a replay; take the whole answer so far
+                    showContent();
+                    if (serverRendered) {
+                        zeroMdElement.firstElementChild.innerHTML = data.html;
+                        pendingBlocks = [];
+                        pendingTail = data.tail;
+                    } else {
+                        fullContent = data.content;
+                    }
+                    scheduleRender();
+                } else if (data.type === 'complete') {
+                    // Final update, then syntax highlighting once zero-md has rendered it
+                    if (serverRendered && data.replace) {
+                        // Rendered again as a whole, for link definitions at the end
+                        zeroMdElement.firstElementChild.innerHTML = '';
+                        pendingBlocks = [];
+                    }
+                    if (serverRendered) queueHtml(data);
+                    render();
+                    if (serverRendered) {
+                        requestAnimationFrame(finish);
+                    } else if (zeroMdElement && renderStart) {
+                        zeroMdElement.addEventListener('zero-md-rendered', finish, { once: true });
+                    } else if (zeroMdElement) {
+                        requestAnimationFrame(finish);
+                    }
+                } else if (data.type === 'error') {
+                    console.error('Streaming error:', data.content);
+                    const contentDiv = document.getElementById('content-' + messageId);
+                    if (contentDiv) {
+                        contentDiv.style.display = 'block';
+                        contentDiv.innerHTML = '<div class="text-red-500 p-4 bg-red-50 rounded border-l-4 border-red-400">❌ ' + data.content + '</div>';
+                    }
+                    const typingDiv = document.getElementById('typing-' + messageId);
+                    if (typingDiv) typingDiv.style.display = 'none';
+                }
+            } catch (e) {
+                console.error('Error parsing SSE data:', e, raw);
+            }
+            return false;
+        };
+    }
+
+    // Two-request path, also used to resume a dropped single-request stream.
+    // Dropped connections reconnect on their own, sending Last-Event-ID so the
+    // server resumes where we left off; give up once the browser stops retrying.
+    function streamWithEventSource(messageId, handle, lastEventId) {
+        let url = '/stream-response?message_id=' + encodeURIComponent(messageId);
+        if (lastEventId) url += '&last_event_id=' + encodeURIComponent(lastEventId);
+        const eventSource = new EventSource(url);
+        let reconnects = 0;
+        eventSource.onopen = function() {
+            reconnects = 0;
+        };
+        eventSource.onmessage = function(event) {
+            if (handle(event.data)) eventSource.close();
+        };
+        eventSource.onerror = function(error) {
+            if (eventSource.readyState !== EventSource.CLOSED && ++reconnects <= 5) {
+                console.warn('EventSource interrupted, reconnecting:', error);
+                return;
+            }
+            console.error('EventSource failed:', error);
+            eventSource.close();
+            // Re-enable form on error
+            reenableForm();
+        };
+    }
+
+    // Minimal SSE parser over a fetch body; calls onEvent(id, data) per event
+    // until it returns true, and throws if the body ends first
+    async function readEventStream(body, onEvent) {
+        const reader = body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) throw new Error('Stream ended before [DONE]');
+            buffer += value;
+            let end;
+            while ((end = buffer.indexOf('\n\n')) !== -1) {
+                const block = buffer.slice(0, end);
+                buffer = buffer.slice(end + 2);
+                let id = null;
+                const data = [];
+                for (const line of block.split('\n')) {
+                    if (line.startsWith('id: ')) id = line.slice(4);
+                    else if (line.startsWith('data: ')) data.push(line.slice(6));
+                }
+                if (data.length && onEvent(id, data.join('\n'))) return;
+            }
+        }
+    }
+
+    function clearInput(form) {
+        const textarea = form.querySelector('textarea');
+        textarea.value = '';
+        textarea.style.height = 'auto';
+    }
+
+    // Single-request path: one POST returns the bubbles and then streams the reply
+    async function sendAndStream(form) {
+        const indicator = document.getElementById('chat-input-container');
+        indicator.classList.add('htmx-request');
+        let messageId = null;
+        let handle = null;
+        let lastEventId = null;
+        try {
+            const response = await fetch(form.action, { method: 'POST', body: new FormData(form) });
+            indicator.classList.remove('htmx-request');
+            if (!response.ok) throw new Error('HTTP ' + response.status + ': ' + await response.text());
+            clearInput(form);
+
+            await readEventStream(response.body, (id, raw) => {
+                if (id) lastEventId = id;
+                if (handle) return handle(raw);
+                // The first event carries the user bubble and the reply placeholder
+                const data = JSON.parse(raw);
+                const chatMessages = document.getElementById('chat-messages');
+                chatMessages.insertAdjacentHTML('beforeend', data.html);
+                chatMessages.scrollTop = chatMessages.scrollHeight;
+                messageId = data.message_id;
+                handle = replyView(messageId, 'single-request');
+                return false;
+            });
+        } catch (e) {
+            indicator.classList.remove('htmx-request');
+            if (handle) {
+                // The reply is still being generated server side; resume it
+                console.warn('Stream interrupted, resuming:', e);
+                streamWithEventSource(messageId, handle, lastEventId);
+            } else {
+                console.error('Send failed:', e);
+                reenableForm();
+            }
+        }
+    }
+
+    document.addEventListener('keydown', (e) => {
+        if (e.target.tagName === 'TEXTAREA' && e.key === 'Enter' && !e.shiftKey) sentAt = performance.now();
+    }, true);
+    document.addEventListener('click', (e) => {
+        if (e.target.closest && e.target.closest('#submit-btn')) sentAt = performance.now();
+    }, true);
+
+    document.addEventListener('submit', (e) => {
+        const form = e.target;
+        if (form.id !== 'chat-form' || form.dataset.streamMode !== 'single-request' || e.defaultPrevented) return;
+        e.preventDefault();
+        sendAndStream(form);
+    });
+
+    // Two-request path: start streaming once htmx has swapped in the placeholder
+    document.addEventListener('htmx:afterRequest', (e) => {
+        if (e.target.id === 'chat-form' && !e.detail.successful) reenableForm();
+    });
+    document.addEventListener('htmx:afterSettle', () => {
+        document.querySelectorAll('#chat-messages [data-stream]:not([data-streaming])').forEach(el => {
+            el.setAttribute('data-streaming', 'true');
+            const messageId = el.dataset.stream;
+            streamWithEventSource(messageId, replyView(messageId, 'two-request'));
+        });
+    });
+})();
@@ -0,0 +1,296 @@
+import json
+import time
+import asyncio
+from collections import OrderedDict, deque
+from itertools import islice
+
+
+SSE_DONE = "data: [DONE]\n\n"
+SSE_KEEPALIVE = ": keepalive\n\n"
+
+
+def sse_event(data, event_id=None):
+    """Format one server-sent event carrying a JSON payload"""
+    event = "data: " + json.dumps(data) + "\n\n"
+    return event if event_id is None else f"id: {event_id}\n" + event
+
+
+async def coalesce(chunks, max_delay=0.05, max_bytes=1024):
+    """Merge small upstream deltas into fewer, larger ones.
+
+    The first delta goes out as soon as it arrives, so merging never adds
+    to the time to first token. After it, buffered text is flushed once
+    `max_delay` seconds have passed since the first buffered delta, or as
+    soon as it reaches `max_bytes` characters, whichever comes first. The
+    delay is enforced with a timer, so a stalled upstream never holds back
+    text that has already arrived.
+    """
+    it = chunks.__aiter__()
+    buffer = []
+    size = 0
+    deadline = None
+    pending = None
+    first = True
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                # Window elapsed while waiting; keep the same pending read for later
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+                continue
+
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if first:
+                first = False
+                yield chunk
+                continue
+
+            buffer.append(chunk)
+            size += len(chunk)
+            if deadline is None:
+                deadline = time.monotonic() + max_delay
+            if size >= max_bytes or time.monotonic() >= deadline:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def merge_chunks(chunks):
+    """One chunk event equivalent to consecutive ones, in order"""
+    merged = {"type": "chunk", "content": "".join(chunk["content"] for chunk in chunks)}
+    if "blocks" in chunks[-1]:
+        merged["blocks"] = [block for chunk in chunks for block in chunk["blocks"]]
+        merged["tail"] = chunks[-1]["tail"]
+    return merged
+
+
+def coalesce_events(pending):
+    """(id, formatted event) for buffered events, with runs of chunks merged into one.
+
+    A merged event carries the id of its last chunk, so resuming from it
+    skips exactly what it contained.
+    """
+    run = []
+    for event_id, data, event, _ in pending:
+        if data is not None and data["type"] == "chunk":
+            run.append((event_id, data, event))
+            continue
+        if run:
+            yield _merged(run)
+            run = []
+        yield event_id, event
+    if run:
+        yield _merged(run)
+
+
+def _merged(run):
+    if len(run) == 1:
+        return run[0][0], run[0][2]
+    return run[-1][0], sse_event(merge_chunks([data for _, data, _ in run]), run[-1][0])
+
+
+class ResponseBuffer:
+    """Recent SSE events of one response, so a dropped client can resume.
+
+    The producer publishes numbered events; any number of connections
+    subscribe from a `Last-Event-ID`. Only the newest `max_events` events
+    are kept. A client that falls further behind gets a snapshot of the
+    answer so far instead. When the last subscriber leaves before the
+    response is done, the producer task is cancelled after `grace` seconds
+    unless someone reconnects first, here or through another process.
+
+    The producer never waits for subscribers, so each one reads at its own
+    pace: chunks that piled up while it was writing are merged into one
+    event. A subscriber whose oldest unsent event has waited more than
+    `max_lag` seconds is a slow client; with `slow_policy` "final" it gets
+    no more chunks, just the whole answer once it is done, and with
+    "disconnect" its stream ends so the client resumes later.
+    """
+
+    def __init__(self, max_events=256, grace=3.0, max_lag=None, slow_policy="final"):
+        self.grace = grace
+        self.max_lag = max_lag
+        self.slow_policy = slow_policy
+        self.events = deque(maxlen=max_events)
+        self.last_id = 0
+        self.parts = []
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.task = None
+        # Optional callable returning extra fields for snapshot events
+        self.snapshot = None
+        # Optional callable given (id, formatted event, done) for every event,
+        # and one telling whether clients elsewhere are still reading
+        self.on_event = None
+        self.watched = None
+        # Optional callable given the policy applied to each slow subscriber
+        self.on_slow = None
+        self._changed = None
+        self._abandon_handle = None
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def publish(self, data):
+        self.last_id += 1
+        self._append(data, sse_event(data, self.last_id))
+        if data["type"] == "chunk":
+            self.parts.append(data["content"])
+        self._notify()
+
+    def finish(self):
+        """Send the [DONE] marker and stop accepting events"""
+        if self.done:
+            return
+        self.last_id += 1
+        self.done = True
+        self._append(None, f"id: {self.last_id}\n" + SSE_DONE)
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _append(self, data, event):
+        self.events.append((self.last_id, data, event, time.monotonic()))
+        if self.on_event is not None:
+            self.on_event(self.last_id, event, self.done)
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set_result(None)
+            self._changed = None
+
+    async def subscribe(self, last_id=0, heartbeat=None):
+        """Yield formatted events after `last_id`, then live ones until [DONE].
+
+        A keepalive comment is sent after `heartbeat` idle seconds, so a
+        vanished client is noticed even while upstream is silent.
+        """
+        self.subscribers += 1
+        if self._abandon_handle is not None:
+            self._abandon_handle.cancel()
+            self._abandon_handle = None
+        subscribed = time.monotonic()
+        final_only = False
+        try:
+            cursor = min(last_id, self.last_id)
+            while True:
+                # Copy first: the producer may append while we are suspended in yield
+                pending = list(islice(self.events, max(cursor + 1 - self.events[0][0], 0), None)) if self.events else []
+                if pending and not final_only and self.max_lag is not None:
+                    # Events are only as old as this subscription, so a replay isn't "late"
+                    if time.monotonic() - max(pending[0][3], subscribed) > self.max_lag:
+                        if self.on_slow is not None:
+                            self.on_slow(self.slow_policy)
+                        if self.slow_policy == "disconnect":
+                            return
+                        final_only = True
+                if not final_only and self.events and cursor + 1 < self.events[0][0]:
+                    # Missed events have left the ring; send the whole answer so far
+                    if self.done:
+                        for event in self._final(list(self.events), cursor):
+                            yield event
+                        return
+                    cursor = self.last_id
+                    yield self._snapshot(cursor)
+                    continue
+                if final_only and self.done:
+                    for event in self._final(pending, cursor):
+                        yield event
+                    return
+                if not final_only:
+                    for event_id, event in coalesce_events(pending):
+                        cursor = event_id
+                        yield event
+                if cursor < self.last_id and not final_only:
+                    # More arrived while we were suspended in yield
+                    continue
+                if self.done and cursor >= self.last_id:
+                    return
+                if self._changed is None:
+                    self._changed = asyncio.get_running_loop().create_future()
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._changed), heartbeat)
+                except asyncio.TimeoutError:
+                    yield SSE_KEEPALIVE
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self._abandon_handle = asyncio.get_running_loop().call_later(self.grace, self._abandon)
+
+    def _snapshot(self, event_id):
+        extra = self.snapshot() if self.snapshot else {}
+        return sse_event({"type": "snapshot", "content": self.text, **extra}, event_id)
+
+    def _final(self, pending, cursor):
+        """The finished answer as one snapshot, then the events after the last chunk"""
+        chunks = [i for i, (_, data, _, _) in enumerate(pending) if data is not None and data["type"] == "chunk"]
+        rest = pending[chunks[-1] + 1:] if chunks else pending
+        yield self._snapshot(pending[chunks[-1]][0] if chunks else cursor)
+        for event_id, data, event, _ in rest:
+            if data is not None and data["type"] == "complete" and "blocks" in data:
+                # The snapshot already holds every block
+                complete = {**data, "blocks": [], "tail": ""}
+                complete.pop("replace", None)
+                event = sse_event(complete, event_id)
+            yield event
+
+    def _abandon(self):
+        self._abandon_handle = None
+        if self.subscribers == 0 and not self.done:
+            if self.watched is not None and self.watched():
+                # Still being relayed by another process; check again later
+                self._abandon_handle = asyncio.get_running_loop().call_later(max(self.grace, 1.0), self._abandon)
+                return
+            self.task.cancel()
+
+
+class ResponseStreams:
+    """Live and recently finished responses by key, bounded in count and age"""
+
+    def __init__(self, ttl=60.0, max_streams=1000, max_events=256, grace=3.0, max_lag=None, slow_policy="final"):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.max_events = max_events
+        self.grace = grace
+        self.max_lag = max_lag
+        self.slow_policy = slow_policy
+        self._buffers = OrderedDict()
+
+    def get(self, key):
+        return self._buffers.get(key)
+
+    def create(self, key):
+        self._sweep()
+        buffer = ResponseBuffer(self.max_events, self.grace, self.max_lag, self.slow_policy)
+        self._buffers[key] = buffer
+        return buffer
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def _sweep(self):
+        cutoff = time.monotonic() - self.ttl
+        over = len(self._buffers) - self.max_streams + 1
+        for key, buffer in list(self._buffers.items()):
+            if not buffer.done:
+                continue
+            if buffer.finished_at < cutoff or over > 0:
+                del self._buffers[key]
+                over -= 1
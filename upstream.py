@@ -0,0 +1,284 @@
+import time
+import random
+import asyncio
+from collections import deque
+from itertools import islice
+
+import httpx
+from openai import AsyncOpenAI
+
+from scheduler import is_retryable
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class ModelBackend:
+    """Where completions come from.
+
+    `stream` yields the text deltas of a reply and `complete` returns a
+    whole one; both take chat messages plus extra model parameters.
+    `warmup` runs at startup and `close` at shutdown. The base class
+    answers every request with an empty reply.
+    """
+
+    models = ()
+
+    async def stream(self, messages, **params):
+        return
+        yield
+
+    async def complete(self, messages, **params):
+        return ""
+
+    async def warmup(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class Endpoint:
+    """One OpenAI-compatible endpoint and model, with its own connection pool.
+
+    Keeps the time to first token of recent streams. Routing uses the
+    median of the last few, which a slow tail barely moves (hedging is
+    what deals with the tail), and hedging a high percentile. After a
+    retryable failure (rate limit, server or connection error) the
+    endpoint is avoided for `cooldown` seconds.
+    """
+
+    def __init__(self, model, base_url=None, api_key=None, name=None, max_connections=100,
+                 max_keepalive=20, keepalive_expiry=60.0, cooldown=10.0, samples=200, recent=20):
+        self.model = model
+        self.name = name or (f"{base_url} {model}" if base_url else model)
+        self.cooldown = cooldown
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                              keepalive_expiry=keepalive_expiry)
+        self.http = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600, connect=10))
+        # Retries happen in the upstream scheduler, which can pick another endpoint
+        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key, max_retries=0, http_client=self.http)
+        self.ttft = deque(maxlen=samples)
+        self.recent = recent
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.failed_at = None
+
+    def record(self, ttft):
+        self.ttft.append(ttft)
+
+    @property
+    def typical(self):
+        """Median of the most recent TTFTs, or None before the first"""
+        if not self.ttft:
+            return None
+        return percentile(islice(reversed(self.ttft), self.recent), 50)
+
+    def fail(self, error):
+        self.errors += 1
+        if is_retryable(error):
+            self.failed_at = time.monotonic()
+
+    @property
+    def cooling(self):
+        return self.failed_at is not None and time.monotonic() - self.failed_at < self.cooldown
+
+    def stats(self):
+        return {
+            "model": self.model,
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ttft_p50": self.typical,
+            "ttft_p95": percentile(self.ttft, 95) if self.ttft else None,
+        }
+
+
+class OpenAIBackend(ModelBackend):
+    """Completions from one or more OpenAI-compatible endpoints.
+
+    Each request goes to the endpoint with the lowest recent time to first
+    token; endpoints not yet measured are tried first, and a fraction
+    `explore` of requests goes to a random one so estimates stay fresh.
+
+    With `hedge_percentile`, a stream that has not produced its first token
+    by that percentile of its endpoint's recent TTFTs (once it has
+    `hedge_min_samples`) gets a second call on the next best endpoint.
+    Whichever yields first is used and the other is cancelled. Hedges are
+    capped at `hedge_budget` of all requests so a slow provider does not
+    get twice the load.
+    """
+
+    def __init__(self, endpoints, hedge_percentile=None, hedge_min_samples=20, hedge_budget=0.1, explore=0.05,
+                 warmup_connections=2, warmup_timeout=5.0, on_connect=None, on_hedge=None):
+        self.endpoints = list(endpoints)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_budget = hedge_budget
+        self.explore = explore
+        self.warmup_connections = warmup_connections
+        self.warmup_timeout = warmup_timeout
+        self.on_connect = on_connect
+        self.on_hedge = on_hedge
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # Closing streams of cancelled hedges, referenced until they finish
+        self._closing = set()
+
+    @property
+    def models(self):
+        return tuple(sorted({endpoint.model for endpoint in self.endpoints}))
+
+    def pick(self, exclude=None):
+        """Best endpoint for the next request, other than `exclude` if there is a choice"""
+        candidates = [e for e in self.endpoints if e is not exclude] or self.endpoints
+        candidates = [e for e in candidates if not e.cooling] or candidates
+        unmeasured = [e for e in candidates if not e.ttft]
+        if unmeasured:
+            return min(unmeasured, key=lambda e: e.inflight)
+        if len(candidates) > 1 and random.random() < self.explore:
+            return random.choice(candidates)
+        return min(candidates, key=lambda e: e.typical)
+
+    def hedge_after(self, endpoint):
+        """Seconds to wait for a first token before hedging, or None to not hedge"""
+        if self.hedge_percentile is None or len(endpoint.ttft) < self.hedge_min_samples:
+            return None
+        if self.hedges >= self.hedge_budget * self.requests:
+            return None
+        return percentile(endpoint.ttft, self.hedge_percentile)
+
+    async def stream(self, messages, **params):
+        self.requests += 1
+        endpoint, stream, chunks, first = await self._first(messages, params)
+        try:
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            endpoint.fail(e)
+            raise
+        finally:
+            endpoint.inflight -= 1
+            await stream.close()
+
+    async def complete(self, messages, **params):
+        endpoint = self.pick()
+        endpoint.requests += 1
+        endpoint.inflight += 1
+        try:
+            response = await endpoint.client.chat.completions.create(
+                messages=messages, model=endpoint.model, **params
+            )
+        except Exception as e:
+            endpoint.fail(e)
+            raise
+        finally:
+            endpoint.inflight -= 1
+        return response.choices[0].message.content
+
+    async def _open(self, endpoint, messages, params):
+        """Start a stream on `endpoint` and read up to its first text.
+
+        Returns (endpoint, stream, iterator, first delta); the stream is
+        closed if this fails or is cancelled.
+        """
+        endpoint.requests += 1
+        endpoint.inflight += 1
+        started = time.perf_counter()
+        stream = None
+        try:
+            stream = await endpoint.client.chat.completions.create(
+                messages=messages, model=endpoint.model, stream=True, **params
+            )
+            if self.on_connect is not None:
+                self.on_connect(time.perf_counter() - started)
+            chunks = stream.__aiter__()
+            async for chunk in chunks:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    endpoint.record(time.perf_counter() - started)
+                    return endpoint, stream, chunks, chunk.choices[0].delta.content
+            return endpoint, stream, chunks, None
+        except BaseException as e:
+            endpoint.inflight -= 1
+            if isinstance(e, Exception):
+                endpoint.fail(e)
+            if stream is not None:
+                await stream.close()
+            raise
+
+    async def _first(self, messages, params):
+        """Open a stream on the best endpoint, hedging it if its first token is late"""
+        primary = self.pick()
+        calls = {asyncio.ensure_future(self._open(primary, messages, params)): "primary"}
+        hedged = False
+        try:
+            done, _ = await asyncio.wait(calls, timeout=self.hedge_after(primary))
+            if not done:
+                hedged = True
+                self.hedges += 1
+                calls[asyncio.ensure_future(self._open(self.pick(exclude=primary), messages, params))] = "hedge"
+
+            error = None
+            while calls:
+                done, _ = await asyncio.wait(calls, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    role = calls.pop(call)
+                    if call.exception() is not None:
+                        error = error or call.exception()
+                        continue
+                    if hedged:
+                        self.hedge_wins += role == "hedge"
+                        if self.on_hedge is not None:
+                            self.on_hedge(role)
+                    return call.result()
+            raise error
+        finally:
+            for call in calls:
+                self._discard(call)
+
+    def _discard(self, call):
+        """Cancel the losing call of a hedged pair, or close its stream if it also finished"""
+        if not call.done():
+            call.cancel()
+            return
+        if call.cancelled() or call.exception() is not None:
+            return
+        endpoint, stream, _, _ = call.result()
+        endpoint.inflight -= 1
+        task = asyncio.ensure_future(stream.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def warmup(self):
+        """Open pooled connections to every endpoint, TLS included, before the first user request"""
+        async def warm(endpoint):
+            try:
+                await asyncio.gather(*(endpoint.client.models.list() for _ in range(self.warmup_connections)))
+            except Exception as e:
+                print(f"Upstream warmup failed for {endpoint.name}: {e}")
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*(warm(e) for e in self.endpoints)), self.warmup_timeout)
+        except asyncio.TimeoutError:
+            print("Upstream warmup timed out")
+
+    async def close(self):
+        await asyncio.gather(*(endpoint.client.close() for endpoint in self.endpoints))
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "endpoints": {endpoint.name: endpoint.stats() for endpoint in self.endpoints},
+        }